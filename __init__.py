@@ -4,6 +4,11 @@ from trytond.pool import Pool
 from . import dish_recipe
 from . import category
 from . import product
+from . import last_cost
+from . import invoice
+from . import ir
+from . import image
+from . import snapshot
 
 
 def register():
@@ -12,7 +17,23 @@ def register():
         dish_recipe.SubRecipe,
         dish_recipe.RecipePrice,
         dish_recipe.RecipePublish,
+        dish_recipe.RecipeCost,
+        snapshot.RecipeCostSnapshot,
         dish_recipe.RecipeComponent,
         category.Category,
+        product.Uom,
         product.Product,
+        product.ProductCostPrice,
+        last_cost.ProductLastCost,
+        image.ImageVariant,
+        ir.Cron,
+        ir.Translation,
+        ir.Attachment,
         module='dish_recipe', type_='model')
+    Pool.register(
+        invoice.Invoice,
+        last_cost.RebuildLastCostStart,
+        module='dish_recipe', type_='model', depends=['account_invoice'])
+    Pool.register(
+        last_cost.RebuildLastCost,
+        module='dish_recipe', type_='wizard', depends=['account_invoice'])
@@ -1,18 +1,27 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.model import ModelView, ModelSQL, fields, tree, sequence_ordered
+from trytond.model import (ModelView, ModelSQL, fields, tree,
+    sequence_ordered, Index)
+from trytond.pool import Pool
 from trytond.pyson import Eval
-from . tools import tool_get_html_field_text
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from trytond.modules.product import price_digits
+from sql import Literal
+from sql.operators import Concat
+from decimal import Decimal
+from . tools import tool_get_html_field_text, tool_get_html_fields_text
 
 
 class Category(tree(separator=' / '), sequence_ordered(), ModelSQL, ModelView):
     "Recipe Category"
     __name__ = "dish_recipe.category"
     name = fields.Char('Name', required=True, translate=True)
-    parent = fields.Many2One('dish_recipe.category', 'Parent',
+    parent = fields.Many2One('dish_recipe.category', 'Parent', path='path',
         domain=[
             ('id', '!=', Eval('id')),
         ], depends=['id'])
+    path = fields.Char('Path', readonly=True)
     childs = fields.One2Many('dish_recipe.category', 'parent',
             string='Children')
     recipes = fields.One2Many('dish_recipe.recipe',
@@ -20,16 +29,122 @@ class Category(tree(separator=' / '), sequence_ordered(), ModelSQL, ModelView):
     info_1 = fields.Char('Info 1')
     info_2 = fields.Char('Info 2')
     info_3 = fields.Char('Info 3')
+    recipe_count = fields.Function(fields.Integer('Recipes',
+            help='The number of active recipes of the category and its '
+            'children.'),
+        'get_rollups')
+    cost_min = fields.Function(fields.Numeric('Minimal Cost',
+            digits=price_digits),
+        'get_rollups')
+    cost_max = fields.Function(fields.Numeric('Maximal Cost',
+            digits=price_digits),
+        'get_rollups')
+    percentage_average = fields.Function(fields.Numeric('Average Percentage',
+            digits=price_digits),
+        'get_rollups')
 
     @classmethod
     def __setup__(cls):
         super(Category, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.path, Index.Similarity(begin=True))))
         cls._order = [
             ('sequence', 'ASC'),
             ('name', 'DESC'),
             ('id', 'DESC'),
             ]
 
+    @classmethod
+    def get_subtree_recipe_ids(cls, categories):
+        """Return the ids of the active recipes of categories and their
+        children indexed by category id"""
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        category = cls.__table__()
+        child = cls.__table__()
+        recipe = Recipe.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {c.id: [] for c in categories}
+        for sub_ids in grouped_slice(list(result)):
+            cursor.execute(*category.join(child,
+                    condition=child.path.like(Concat(category.path, '%'))
+                    ).join(recipe, condition=recipe.category == child.id
+                    ).select(category.id, recipe.id,
+                    where=reduce_ids(category.id, sub_ids)
+                    & (recipe.active == Literal(True))))
+            for category_id, recipe_id in cursor:
+                result[category_id].append(recipe_id)
+        return result
+
+    @classmethod
+    def get_rollups(cls, categories, names):
+        """Compute the cost aggregates of the recipes of the categories
+        subtree
+
+        The costs are read once for all the recipes with the stored or the
+        batched cost engine.
+        """
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+
+        subtrees = cls.get_subtree_recipe_ids(categories)
+        recipes = Recipe.browse(list({i for l in subtrees.values()
+                    for i in l}))
+        costs = Recipe.get_cost(recipes, ['cost', 'percentage'])
+        result = {n: {} for n in names}
+        for category in categories:
+            recipe_ids = subtrees[category.id]
+            cost_values = [costs['cost'][i] for i in recipe_ids
+                if costs['cost'][i] is not None]
+            percentages = [costs['percentage'][i] for i in recipe_ids
+                if costs['percentage'][i] is not None]
+            values = {
+                'recipe_count': len(recipe_ids),
+                'cost_min': min(cost_values, default=None),
+                'cost_max': max(cost_values, default=None),
+                'percentage_average': None,
+                }
+            if percentages:
+                values['percentage_average'] = (
+                    sum(percentages) / len(percentages)).quantize(
+                        Decimal(str(10.0 ** -price_digits[1])))
+            for name in names:
+                result[name][category.id] = values[name]
+        return result
+
+    @classmethod
+    def get_rec_name(cls, categories, name):
+        "Build the full names from the stored paths"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # The path of descendants is updated in SQL so it is not read from
+        # the records cache
+        paths = {}
+        for sub_ids in grouped_slice([c.id for c in categories]):
+            cursor.execute(*table.select(table.id, table.path,
+                    where=reduce_ids(table.id, sub_ids)))
+            paths.update((i, [int(x) for x in p.split('/')[:-1]])
+                for i, p in cursor if p)
+        ids = {i for p in paths.values() for i in p}
+        names = {c['id']: c['name'] for c in cls.read(list(ids), ['name'])}
+        rec_names = {}
+        for category in categories:
+            if category.id in paths:
+                rec_names[category.id] = ' / '.join(
+                    names[i] for i in paths[category.id])
+            else:
+                rec_names[category.id] = super(
+                    Category, category).get_rec_name(name)
+        return rec_names
+
+    @classmethod
+    def get_html_fields_text(cls, categories, fields, lang):
+        return tool_get_html_fields_text(
+            'dish_recipe.category', fields, [c.id for c in categories], lang)
+
     def get_html_field_text(self, field, lang):
         text = getattr(self, field)
         res = tool_get_html_field_text(
@@ -1,16 +1,91 @@
 #This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
-from trytond.model import ModelView, ModelSQL, fields,  sequence_ordered
+from trytond.model import (ModelView, ModelSQL, fields, sequence_ordered,
+    Index, Unique)
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.i18n import gettext
+from trytond.config import config
+from trytond.rpc import RPC
+from trytond.cache import Cache
+from trytond.tools.domain_inversion import eval_domain
+from sql import Column, Literal, With
 from trytond.pyson import Bool, Eval, If
 from trytond.modules.company.model import (
     CompanyMultiValueMixin, CompanyValueMixin)
-from trytond.modules.product import price_digits
+from trytond.modules.product import price_digits, uom_conversion_digits
 from trytond.modules.account.tax import _TaxKey
 from decimal import Decimal
 import base64
-from . tools import tool_get_html_field_text, tool_get_html_base64_image
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from operator import mul, truediv
+from . tools import (tool_get_html_field_text, tool_get_html_fields_text,
+    tool_get_attachment, tool_get_base64_data, tool_iter_base64_data,
+    tool_get_transaction_cache, tool_instrument, tool_get_instrument_stats)
+from . exceptions import (RecipeCycleError, RecipeProductError,
+    RecipeImportError)
+
+logger = logging.getLogger(__name__)
+
+IMPORT_FIELDS = ['name', 'description', 'preparation', 'sequence', 'info_1',
+    'info_2', 'info_3', 'active']
+STORED_COSTS = ['cost', 'cost_last', 'percentage', 'percentage_last']
+
+
+def _recost_initializer(database_name, options):
+    from trytond.worker import initializer
+    # Use the configuration of the parent which may not come from
+    # TRYTOND_CONFIG
+    for section, values in options.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in values.items():
+            config.set(section, option, value)
+    initializer([database_name])
+
+
+def _recost_worker(args):
+    database_name, user, context, recipe_ids, company_ids, batch_size = args
+    with Transaction().start(database_name, user, readonly=True,
+            context=context):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        return Recipe.compute_catalog_costs(
+            recipe_ids, company_ids, batch_size, processes=1)
+
+
+def _product_key(product):
+    "Return the key referencing product in import and export"
+    return product.code or product.name
+
+
+def _order_stored_cost(name):
+    """Return the order method of a cost stored in dish_recipe.recipe.cost
+
+    The recipes are not ordered when the costs are not stored.
+    """
+    def order(tables):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Cost = pool.get('dish_recipe.recipe.cost')
+        if not Recipe.stored_costs():
+            return []
+        table, _ = tables[None]
+        if 'stored_cost' not in tables:
+            cost = Cost.__table__()
+            company = Transaction().context.get('company')
+            tables['stored_cost'] = {
+                None: (cost, (cost.recipe == table.id)
+                    & (cost.company == company)),
+                }
+        cost, _ = tables['stored_cost'][None]
+        return [Column(cost, name)]
+    return staticmethod(order)
 
 
 class Recipe(ModelSQL, ModelView, sequence_ordered(), CompanyMultiValueMixin):
@@ -31,32 +106,34 @@ class Recipe(ModelSQL, ModelView, sequence_ordered(), CompanyMultiValueMixin):
     attachments = fields.One2Many('ir.attachment', 'resource', 'Attachments')
     cost_components = fields.Function(fields.Numeric('Cost',
             digits=price_digits),
-        'get_cost_components')
+        'get_cost')
     cost_last_components = fields.Function(fields.Numeric('Last Cost',
             digits=price_digits),
-        'get_cost_components')
+        'get_cost')
     cost_subrecipes = fields.Function(fields.Numeric('Cost',
             digits=price_digits),
-        'get_cost_subrecipes')
+        'get_cost')
     cost_last_subrecipes = fields.Function(fields.Numeric('Last Cost',
             digits=price_digits),
-        'get_cost_subrecipes')
+        'get_cost')
     cost = fields.Function(fields.Numeric('Cost',
             digits=price_digits),
-        'get_cost')
+        'get_cost', searcher='search_cost')
     cost_last = fields.Function(fields.Numeric('Last Cost',
             digits=price_digits),
-        'get_cost')
+        'get_cost', searcher='search_cost')
+    costs = fields.One2Many(
+        'dish_recipe.recipe.cost', 'recipe', 'Costs', readonly=True)
     price = fields.MultiValue(fields.Numeric('Price',
             digits=price_digits))
     prices = fields.One2Many(
         'dish_recipe.price', 'recipe', 'Prices')
     percentage = fields.Function(fields.Numeric('Percentage',
             digits=price_digits),
-        'get_percentage')
+        'get_cost', searcher='search_cost')
     percentage_last = fields.Function(fields.Numeric('Percentage',
             digits=price_digits),
-        'get_percentage')
+        'get_cost', searcher='search_cost')
     product = fields.Many2One('product.product', 'Product associated',
         help='Product associated with this recipe.')
     info_1 = fields.Char('Info 1')
@@ -67,6 +144,16 @@ class Recipe(ModelSQL, ModelView, sequence_ordered(), CompanyMultiValueMixin):
         'dish_recipe.publish', 'recipe', 'Puplishes')
     active = fields.Boolean('Active')
 
+    order_cost = _order_stored_cost('cost')
+    order_cost_last = _order_stored_cost('cost_last')
+    order_percentage = _order_stored_cost('percentage')
+    order_percentage_last = _order_stored_cost('percentage_last')
+
+    _html_cache = Cache(
+        'dish_recipe.recipe.html', size_limit=10240, context=False)
+    _bom_cache = Cache(
+        'dish_recipe.recipe.bom', size_limit=10240, context=False)
+
     @classmethod
     def __register__(cls, module_name):
         super(Recipe, cls).__register__(module_name)
@@ -79,6 +166,10 @@ class Recipe(ModelSQL, ModelView, sequence_ordered(), CompanyMultiValueMixin):
     @classmethod
     def __setup__(cls):
         super(Recipe, cls).__setup__()
+        cls.__rpc__.update({
+                'get_catalog_costs': RPC(),
+                'get_instrument_stats': RPC(),
+                })
         cls._order = [
             ('sequence', 'ASC'),
             ('name', 'DESC'),
@@ -99,38 +190,80 @@ class Recipe(ModelSQL, ModelView, sequence_ordered(), CompanyMultiValueMixin):
         return True
 
     def get_html_field_text(self, field, lang):
+        # The text falls back to the value in the language of the transaction
+        key = (self.id, field, lang, Transaction().language)
+        res = self._html_cache.get(key)
+        if res is not None:
+            return res
         text = getattr(self, field)
         res = tool_get_html_field_text(
-                'dish_recipe.recipe', field, self.id, text, lang)        
+                'dish_recipe.recipe', field, self.id, text, lang)
+        self._html_cache.set(key, res)
         return res
 
+    @classmethod
+    def get_html_fields_text(cls, recipes, fields, lang):
+        return tool_get_html_fields_text(
+            'dish_recipe.recipe', fields, [r.id for r in recipes], lang)
+
     def get_html_price(self, field, lang='en', company=1):
+        key = (self.id, 'price', lang, company)
+        res = self._html_cache.get(key)
+        if res is None:
+            res = self.get_html_prices([self], lang=lang, company=company)[
+                self.id]
+            self._html_cache.set(key, res)
+        return res
+
+    @classmethod
+    def get_html_prices(cls, recipes, lang='en', company=1):
+        """Return the formatted prices of recipes for the company indexed
+        by recipe id"""
         pool = Pool()
         Lang = pool.get('ir.lang')
-        Price = pool.get('dish_recipe.price')
 
-        prices = Price.search([
-            ('company', '=', company),
-            ('recipe', '=', self.id),
-            ])
-        res = None
-        if prices:
-            res = prices[0].price
-        if not res:
-            res = Decimal('0.0')
-
-        lang, = Lang.search([
-                ('code', '=', lang),
-                ])
-        res = Lang.format(lang,
-            '%.2f',
-            res, True)
+        lang = Lang.get(lang)
+        prices = cls._get_prices([r.id for r in recipes], company=company)
+        res = {}
+        for recipe in recipes:
+            price = prices.get(recipe.id) or Decimal('0.0')
+            res[recipe.id] = lang.format('%.2f', price, True)
         return res
 
     def get_html_base64_image(self, image_name, code='image/jpeg',
-            default_image=None):
-        pool = Pool()
+            default_image=None, size=None):
+        """Return the html base64 data of the image
+
+        size is one of the keys of IMAGE_SIZES or None for the original
+        image.
+        """
+        attachment_id, checksum = self._get_html_image(
+            image_name, default_image)
         res = None
+        if attachment_id is not None:
+            res = tool_get_base64_data(
+                attachment_id, checksum, code, size=size)
+        if res is None:
+            res = ''
+        return res
+
+    def iter_html_base64_image(self, image_name, code='image/jpeg',
+            default_image=None, chunk_size=3 * 64 * 1024, size=None):
+        "Same as get_html_base64_image but yield the data in chunks"
+        attachment_id, checksum = self._get_html_image(
+            image_name, default_image)
+        if attachment_id is not None:
+            yield from tool_iter_base64_data(
+                attachment_id, checksum, code, chunk_size, size=size)
+
+    def _get_html_image(self, image_name, default_image=None):
+        "Return the attachment id and checksum of the image"
+        pool = Pool()
+        key = (self.id, ('image', image_name, default_image), None, None)
+        res = self._html_cache.get(key)
+        if res is not None:
+            return res
+        res = None, None
         if image_name:
             if image_name.startswith("[["):
                 Recipe = pool.get('dish_recipe.recipe')
@@ -138,86 +271,291 @@ class Recipe(ModelSQL, ModelView, sequence_ordered(), CompanyMultiValueMixin):
                 if end > -1:
                     recipe_id = int(image_name[2:end])
                     image_name = image_name[end+3:]
-                    res = tool_get_html_base64_image(Recipe(recipe_id),
-                            image_name, code)
+                    res = tool_get_attachment(Recipe(recipe_id), image_name)
             else:
-                res = tool_get_html_base64_image(self,
-                        image_name, code)
-        if res is None and default_image is not None:
-            res = self.get_html_base64_image(default_image, code=code)
-        if res is None:
-            res = ''
+                res = tool_get_attachment(self, image_name)
+        if res[0] is None and default_image is not None:
+            res = self._get_html_image(default_image)
+        self._html_cache.set(key, res)
         return res
 
     def can_publish(self, company=1):
-        if not self.active:
-            return
+        return self.can_publish_recipes([self], company=company)[self.id]
+
+    @classmethod
+    def can_publish_recipes(cls, recipes, company=1):
+        """Return the publish flag of recipes for the company indexed by
+        recipe id, it is None for inactive recipes"""
         pool = Pool()
         Publish = pool.get('dish_recipe.publish')
-        publishes = Publish.search([
-            ('company', '=', company),
-            ('recipe', '=', self.id),
-            ])
-        res = None
-        if publishes:
-            res = publishes[0].publish
-        return res
+        publish = Publish.__table__()
+        cursor = Transaction().connection.cursor()
 
-    def get_cost_components(self, name=None):
-        if name == 'cost_components':
-            field = 'total_cost'
-        elif name == 'cost_last_components':
-            field = 'total_cost_last'
-        return self.get_total_sub_cost('components', field)
-
-    def get_cost_subrecipes(self, name=None):
-        if name == 'cost_subrecipes':
-            field = 'total_cost'
-        elif name == 'cost_last_subrecipes':
-            field = 'total_cost_last'
-        return self.get_total_sub_cost('subrecipes', field)
-
-    def get_total_sub_cost(self, main, field):
-        result = Decimal('0.0')
-        for el in getattr(self, main):
-            if getattr(el, field):
-                result += getattr(el, field)
-        exp = Decimal(str(10.0 ** -price_digits[1]))
-        return result.quantize(exp)
+        active_ids = [r.id for r in recipes if r.active]
+        publishes = {}
+        for sub_ids in grouped_slice(active_ids):
+            cursor.execute(*publish.select(publish.recipe, publish.publish,
+                    where=reduce_ids(publish.recipe, sub_ids)
+                    & (publish.company == company)))
+            for recipe_id, value in cursor:
+                if value is not None:
+                    value = bool(value)
+                publishes[recipe_id] = value
+        return {r.id: publishes.get(r.id) for r in recipes}
 
-    def get_cost(self, name=None):
-        if name == 'cost':
-            return self.cost_components + self.cost_subrecipes
-        elif name == 'cost_last':
-            return self.cost_last_components + self.cost_last_subrecipes
-
-    def get_percentage(self, name=None):
-        if name == 'percentage':
-            field = 'cost'
-        elif name == 'percentage_last':
-            field = 'cost_last'
-        if self.price is None or getattr(self, field) is None:
-            return
-        result = getattr(self, field) / self.price * Decimal('100.0')
+    @classmethod
+    def get_cost(cls, recipes, names):
+        if cls.stored_costs() and set(names) <= set(STORED_COSTS):
+            costs = cls._get_stored_costs(recipes)
+        else:
+            costs = cls.get_costs(recipes)
+        result = {}
+        for name in names:
+            result[name] = {r.id: costs[r.id][name] for r in recipes}
+        return result
+
+    @staticmethod
+    def stored_costs():
+        "Return if the costs are stored in dish_recipe.recipe.cost"
+        return config.getboolean('dish_recipe', 'stored_costs', default=False)
+
+    @classmethod
+    def _get_stored_costs(cls, recipes):
+        pool = Pool()
+        Cost = pool.get('dish_recipe.recipe.cost')
+        cost = Cost.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = Transaction().context.get('company')
+        result = {}
+        for sub_ids in grouped_slice([r.id for r in recipes]):
+            cursor.execute(*cost.select(cost.recipe,
+                    *[Column(cost, f) for f in STORED_COSTS],
+                    where=reduce_ids(cost.recipe, sub_ids)
+                    & (cost.company == company)))
+            for recipe_id, *values in cursor:
+                result[recipe_id] = dict(zip(STORED_COSTS, values))
+        missing = [r for r in recipes if r.id not in result]
+        if missing:
+            result.update(cls.get_costs(missing))
+        return result
+
+    @classmethod
+    def search_cost(cls, name, clause):
+        _, operator, value = clause
+        if cls.stored_costs():
+            company = Transaction().context.get('company')
+            return [('costs', 'where', [
+                        ('company', '=', company),
+                        (name, operator, value),
+                        ])]
+        recipes = cls.search([])
+        costs = cls.get_costs(recipes)
+        return [('id', 'in', [r.id for r in recipes
+                    if eval_domain([clause], costs[r.id])])]
+
+    @classmethod
+    @tool_instrument('dish_recipe.recipe.get_costs')
+    def get_costs(cls, recipes):
+        """Return the cost values of recipes indexed by recipe id
+
+        The recipes and all their nested subrecipes are costed in
+        topological order so each recipe is computed only once per
+        transaction and company. Components, subrecipes and prices are read
+        per nesting level so the number of queries does not depend on the
+        number of recipes.
+        """
+        pool = Pool()
+        Component = pool.get('dish_recipe.recipe.component')
+        SubRecipe = pool.get('dish_recipe.recipe.subrecipe')
+
+        company = Transaction().context.get('company')
+        cache_name = cls.__name__ + '.costs'
+        date = Transaction().context.get('_dish_recipe_cost_date')
+        if date:
+            cache_name += '.' + date.isoformat()
+        cache = tool_get_transaction_cache(cache_name)
+        memo = {}
+        for recipe in recipes:
+            if (company, recipe.id) in cache:
+                memo[recipe.id] = cache[(company, recipe.id)]
+        missing = {r.id for r in recipes} - set(memo)
+        if not missing:
+            return memo
+
+        components, subrecipes = cls._get_cost_graph(
+            missing, [i for c, i in cache.keys() if c == company])
+        for sub_id in {s.subrecipe.id for l in subrecipes.values()
+                for s in l}:
+            if (company, sub_id) in cache and sub_id not in components:
+                memo[sub_id] = cache[(company, sub_id)]
+
+        all_components = [c for l in components.values() for c in l]
+        component_costs = {}
+        for component, costs in zip(
+                all_components, Component.get_costs(all_components)):
+            component_costs.setdefault(component.recipe.id, []).append(costs)
+        prices = cls._get_prices(list(components))
+
+        graph = {i: [s.subrecipe.id for s in subrecipes[i]]
+            for i in components}
+        for recipe_id in cls._sort_cost_graph(graph):
+            subrecipe_costs = [
+                SubRecipe._line_costs(s.quantity, memo[s.subrecipe.id])
+                for s in subrecipes[recipe_id]]
+            memo[recipe_id] = cache[(company, recipe_id)] = cls._sum_costs(
+                component_costs.get(recipe_id, []), subrecipe_costs,
+                prices.get(recipe_id))
+        return memo
+
+    @classmethod
+    def _get_cost_graph(cls, recipe_ids, known_ids, known=None):
+        """Return components and subrecipes of recipes and their nested
+        subrecipes indexed by recipe id
+
+        The subrecipes of known_ids are not loaded nor those for which the
+        optional function known returns True.
+        """
+        pool = Pool()
+        Component = pool.get('dish_recipe.recipe.component')
+        SubRecipe = pool.get('dish_recipe.recipe.subrecipe')
+
+        components, subrecipes = {}, {}
+        known_ids = set(known_ids)
+        todo = set(recipe_ids)
+        while todo:
+            for recipe_id in todo:
+                components[recipe_id] = []
+                subrecipes[recipe_id] = []
+            for sub_ids in grouped_slice(list(todo)):
+                sub_ids = list(sub_ids)
+                for component in Component.search([
+                            ('recipe', 'in', sub_ids),
+                            ]):
+                    components[component.recipe.id].append(component)
+                for subrecipe in SubRecipe.search([
+                            ('recipe', 'in', sub_ids),
+                            ]):
+                    subrecipes[subrecipe.recipe.id].append(subrecipe)
+            todo = {s.subrecipe.id for i in todo for s in subrecipes[i]}
+            todo -= known_ids
+            todo -= set(components)
+            if known:
+                todo = {i for i in todo if not known(i)}
+        return components, subrecipes
+
+    @classmethod
+    def _sort_cost_graph(cls, graph):
+        """Return the recipe ids of graph with subrecipes before the recipes
+        using them
+
+        graph maps a recipe id to the ids of its subrecipes, those missing
+        from graph are considered already costed.
+        """
+        order, done = [], set()
+        for root in graph:
+            if root in done:
+                continue
+            path = [root]
+            stack = [iter(graph[root])]
+            while stack:
+                for child in stack[-1]:
+                    if child not in graph or child in done:
+                        continue
+                    if child in path:
+                        cls._raise_cycle(path[path.index(child):] + [child])
+                    path.append(child)
+                    stack.append(iter(graph[child]))
+                    break
+                else:
+                    stack.pop()
+                    recipe_id = path.pop()
+                    done.add(recipe_id)
+                    order.append(recipe_id)
+        return order
+
+    @classmethod
+    def _raise_cycle(cls, recipe_ids):
+        recipes = {r.id: r for r in cls.browse(list(set(recipe_ids)))}
+        raise RecipeCycleError(
+            gettext('dish_recipe.msg_recipe_cycle',
+                recipes=' → '.join(recipes[i].rec_name for i in recipe_ids)))
+
+    @classmethod
+    def _get_prices(cls, recipe_ids, company=None):
+        pool = Pool()
+        Price = pool.get('dish_recipe.price')
+        price = Price.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if company is None:
+            company = Transaction().context.get('company')
+        result = {}
+        if company is None:
+            return result
+        for sub_ids in grouped_slice(recipe_ids):
+            cursor.execute(*price.select(price.recipe, price.price,
+                    where=reduce_ids(price.recipe, sub_ids)
+                    & (price.company == company)))
+            result.update(cursor)
+        return result
+
+    @staticmethod
+    def _sum_costs(component_costs, subrecipe_costs, price):
+        """Return the cost values of a recipe from the cost values of its
+        component and subrecipe lines"""
         exp = Decimal(str(10.0 ** -price_digits[1]))
-        return result.quantize(exp)
+        res = {}
+        for field in ('cost', 'cost_last'):
+            for name, lines in (
+                    ('components', component_costs),
+                    ('subrecipes', subrecipe_costs)):
+                total = Decimal('0.0')
+                for costs in lines:
+                    if costs['total_' + field]:
+                        total += costs['total_' + field]
+                res['%s_%s' % (field, name)] = total.quantize(exp)
+            res[field] = (res[field + '_components']
+                + res[field + '_subrecipes'])
+
+        for name, field in (
+                ('percentage', 'cost'),
+                ('percentage_last', 'cost_last')):
+            if not price:
+                res[name] = None
+                continue
+            res[name] = (res[field] / price * Decimal('100.0')).quantize(exp)
+        return res
 
     @fields.depends('cost', 'cost_last', 'percentage',
             'percentage_last', 'components', 'subrecipes',
             'price')
     def on_change_price(self):
-        self.cost_components = self.get_cost_components(
-                name='cost_components')
-        self.cost_last_components = self.get_cost_components(
-                name='cost_last_components')
-        self.cost_subrecipes = self.get_cost_subrecipes(
-                name='cost_subrecipes')
-        self.cost_last_subrecipes = self.get_cost_subrecipes(
-                name='cost_last_subrecipes')
-        self.cost = self.get_cost(name='cost')
-        self.cost_last = self.get_cost(name='cost_last')
-        self.percentage = self.get_percentage(name='percentage')
-        self.percentage_last = self.get_percentage(name='percentage_last')
+        """Sum the line totals of the form
+
+        Only the lines without totals yet are costed, the others are
+        already up to date from their own on_change.
+        """
+        pool = Pool()
+        Component = pool.get('dish_recipe.recipe.component')
+        SubRecipe = pool.get('dish_recipe.recipe.subrecipe')
+
+        line_costs = []
+        for Model, lines in [
+                (Component, self.components or []),
+                (SubRecipe, self.subrecipes or [])]:
+            costs = [{
+                    'total_cost': getattr(l, 'total_cost', None),
+                    'total_cost_last': getattr(l, 'total_cost_last', None),
+                    } for l in lines]
+            missing = [i for i, c in enumerate(costs) if None in c.values()]
+            for i, line_cost in zip(missing,
+                    Model.get_costs([lines[i] for i in missing])):
+                costs[i] = line_cost
+            line_costs.append(costs)
+        costs = self._sum_costs(*line_costs, self.price)
+        for name, value in costs.items():
+            setattr(self, name, value)
 
     @fields.depends(methods=['on_change_price'])
     def on_change_components(self):
@@ -227,12 +565,666 @@ class Recipe(ModelSQL, ModelView, sequence_ordered(), CompanyMultiValueMixin):
     def on_change_subrecipes(self):
         self.on_change_price()
 
+    @classmethod
+    def update_costs(cls, recipes, parents=True):
+        """Recompute the stored costs of recipes
+
+        If parents is set, the recipes using them as nested subrecipe are
+        also recomputed.
+        """
+        if (not cls.stored_costs()
+                or Transaction().context.get('_dish_recipe_defer_costs')):
+            return
+        recipe_ids = {r.id for r in recipes}
+        if parents:
+            recipe_ids |= cls._get_dependent_recipe_ids(recipe_ids=recipe_ids)
+        recipe_ids -= Transaction().delete_records.get(cls.__name__, set())
+        if recipe_ids:
+            cls.store_costs(cls.browse(list(recipe_ids)))
+
+    @classmethod
+    def update_product_costs(cls, products):
+        "Recompute the stored costs of the recipes depending on products"
+        if not cls.stored_costs():
+            return
+        cls.update_costs(cls.get_product_recipes(products), parents=False)
+
+    @classmethod
+    def get_product_recipes(cls, products):
+        """Return the recipes using products as component and all the
+        recipes using them as nested subrecipe"""
+        return cls.browse(sorted(cls._get_dependent_recipe_ids(
+                    product_ids={p.id for p in products})))
+
+    @classmethod
+    def recost_products(cls, products):
+        """Return the costs of the recipes depending on products indexed by
+        recipe id and update their stored costs"""
+        recipes = cls.get_product_recipes(products)
+        if cls.stored_costs():
+            cls.store_costs(recipes)
+        return cls.get_costs(recipes)
+
+    @classmethod
+    def store_costs(cls, recipes):
+        "Compute and store the costs of recipes for all the companies"
+        # The costs must include the changes of the transaction which are
+        # not seen by other processes
+        cls._store_cost_rows(cls.compute_catalog_costs(
+                [r.id for r in recipes], processes=1))
+
+    @classmethod
+    def recost_catalog(cls):
+        "Compute and store the costs of all the recipes for all the companies"
+        cls._store_cost_rows(cls.compute_catalog_costs())
+
+    @classmethod
+    def snapshot_costs(cls, date=None):
+        """Store a snapshot of the costs of all the recipes for all the
+        companies at date
+
+        Without date, the costs of today are used. For a past date the last
+        costs are computed from the invoices up to the date but the costs
+        and the prices are the current ones as their history is not kept.
+        The date can not be earlier than the latest snapshot.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Snapshot = pool.get('dish_recipe.recipe.cost.snapshot')
+        today = Date.today()
+        if date is None:
+            date = today
+        context = {}
+        if date < today:
+            context['_dish_recipe_cost_date'] = date
+        with Transaction().set_context(context):
+            rows = cls.compute_catalog_costs()
+        Snapshot.take_snapshots(rows, date)
+
+    @classmethod
+    def get_costs_at(cls, recipes, date, company=None):
+        """Return the price and cost values of recipes as of date indexed by
+        recipe id
+
+        The values of the latest snapshot on or before date are used. The
+        recipes without snapshot are costed with the last costs invoiced up
+        to date and the current cost prices and prices.
+        """
+        pool = Pool()
+        Snapshot = pool.get('dish_recipe.recipe.cost.snapshot')
+
+        if company is None:
+            company = Transaction().context.get('company')
+        result = Snapshot.get_snapshots(
+            [r.id for r in recipes], date, company=company)
+        missing = [r for r in recipes if r.id not in result]
+        if missing:
+            with Transaction().set_context(
+                    company=company, _dish_recipe_cost_date=date):
+                costs = cls.get_costs(missing)
+                prices = cls._get_prices([r.id for r in missing])
+            for recipe in missing:
+                values = {f: costs[recipe.id][f] for f in STORED_COSTS}
+                values['price'] = prices.get(recipe.id)
+                values['date'] = None
+                result[recipe.id] = values
+        return result
+
+    @classmethod
+    def get_menu_costs(cls, lines):
+        """Return the cost, the last cost and the bill of materials of a menu
+
+        lines is a list of (recipe, portions). The bill of materials maps
+        (product id, unit id) to the quantity, waste included, of the
+        components of the recipes and all their nested subrecipes.
+        The recipes are loaded once per nesting level and the portions are
+        accumulated from the menu down to the subrecipes in a single pass.
+        """
+        pool = Pool()
+        Component = pool.get('dish_recipe.recipe.component')
+
+        portions = {}
+        for recipe, quantity in lines:
+            portions[recipe.id] = portions.get(recipe.id, 0) + float(quantity)
+        components, subrecipes = cls._get_cost_graph(list(portions), [])
+        graph = {i: [s.subrecipe.id for s in subrecipes[i]]
+            for i in components}
+        # Recipes are sorted before their subrecipes
+        for recipe_id in reversed(cls._sort_cost_graph(graph)):
+            quantity = portions.get(recipe_id)
+            if not quantity:
+                continue
+            for subrecipe in subrecipes[recipe_id]:
+                if subrecipe.quantity:
+                    sub_id = subrecipe.subrecipe.id
+                    portions[sub_id] = (portions.get(sub_id, 0)
+                        + quantity * subrecipe.quantity)
+
+        all_components = [c for i in components for c in components[i]
+            if portions.get(i)]
+        cost, cost_last = Decimal('0.0'), Decimal('0.0')
+        products = {}
+        for component, costs in zip(
+                all_components, Component.get_costs(all_components)):
+            quantity = portions[component.recipe.id]
+            cost += costs['total_cost'] * Decimal(quantity)
+            cost_last += costs['total_cost_last'] * Decimal(quantity)
+            if component.product and component.unit and component.quantity:
+                key = (component.product.id, component.unit.id)
+                products[key] = products.get(key, 0) + (
+                    component._apply_waste(component.quantity * quantity))
+        exp = Decimal(str(10.0 ** -price_digits[1]))
+        return {
+            'cost': cost.quantize(exp),
+            'cost_last': cost_last.quantize(exp),
+            'products': products,
+            }
+
+    @classmethod
+    def get_boms(cls, recipes):
+        """Return the flattened bill of materials of one portion of recipes
+        indexed by recipe id
+
+        A bill of materials maps product id to the quantity in the default
+        unit of the product, waste included, of the components of the
+        recipe and all its nested subrecipes. The expansion of each recipe is
+        cached until a component or subrecipe is modified.
+        """
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        memo = {}
+
+        def cached(recipe_id):
+            bom = cls._bom_cache.get(recipe_id)
+            if bom is not None:
+                memo[recipe_id] = bom
+            return bom is not None
+        missing = {r.id for r in recipes if not cached(r.id)}
+        if missing:
+            # The nested subrecipes already expanded are not loaded
+            components, subrecipes = cls._get_cost_graph(
+                missing, [], known=cached)
+            graph = {i: [s.subrecipe.id for s in subrecipes[i]]
+                for i in components}
+            for recipe_id in cls._sort_cost_graph(graph):
+                bom = {}
+                for component in components[recipe_id]:
+                    product = component.product
+                    if (not product or not component.unit
+                            or not component.quantity):
+                        continue
+                    quantity = Uom.compute_qty(component.unit,
+                        component._apply_waste(component.quantity),
+                        product.default_uom, round=False)
+                    bom[product.id] = bom.get(product.id, 0) + quantity
+                for subrecipe in subrecipes[recipe_id]:
+                    if not subrecipe.quantity:
+                        continue
+                    for product_id, quantity in memo[
+                            subrecipe.subrecipe.id].items():
+                        bom[product_id] = (bom.get(product_id, 0)
+                            + quantity * subrecipe.quantity)
+                cls._bom_cache.set(recipe_id, bom)
+                memo[recipe_id] = bom
+        return {r.id: dict(memo[r.id]) for r in recipes}
+
+    @classmethod
+    def explode_bom(cls, lines):
+        """Return the quantities of products needed for lines, a list of
+        (recipe, portions), indexed by product id"""
+        boms = cls.get_boms([r for r, _ in lines])
+        result = {}
+        for recipe, portions in lines:
+            for product_id, quantity in boms[recipe.id].items():
+                result[product_id] = (result.get(product_id, 0)
+                    + quantity * float(portions))
+        return result
+
+    @classmethod
+    def compute_catalog_costs(cls, recipe_ids=None, company_ids=None,
+            batch_size=None, processes=None):
+        """Return the price and costs of recipes for companies
+
+        The result is a list of tuples (company, recipe, price, cost,
+        cost_last, percentage, percentage_last). All the recipes and
+        companies are used when they are not given. The recipes are costed
+        by batches and the duration of each batch is logged.
+        With more than one process, the independent groups of recipes are
+        costed in parallel from the committed data.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        if recipe_ids is None:
+            recipe_ids = [r.id for r in cls.search([])]
+        if company_ids is None:
+            company_ids = [c.id for c in Company.search([])]
+        if processes is None:
+            processes = config.getint(
+                'dish_recipe', 'recost_processes', default=1)
+        if processes > 1 and len(recipe_ids) > 1:
+            return cls._compute_catalog_costs_parallel(
+                recipe_ids, company_ids, batch_size, processes)
+        batches = [list(b) for b in grouped_slice(recipe_ids, batch_size)]
+
+        result = []
+        for company_id in company_ids:
+            with Transaction().set_context(company=company_id):
+                for i, sub_ids in enumerate(batches, 1):
+                    start = time.perf_counter()
+                    costs = cls.get_costs(cls.browse(sub_ids))
+                    prices = cls._get_prices(sub_ids)
+                    for recipe_id in sub_ids:
+                        result.append((company_id, recipe_id,
+                                prices.get(recipe_id))
+                            + tuple(costs[recipe_id][f]
+                                for f in STORED_COSTS))
+                    logger.info(
+                        'company %s: batch %s/%s of %s recipes costed '
+                        'in %.3fs', company_id, i, len(batches),
+                        len(sub_ids), time.perf_counter() - start)
+        return result
+
+    @classmethod
+    def get_catalog_costs(cls, recipe_ids=None, company_ids=None,
+            batch_size=None):
+        """Return the price and costs of recipes for the companies of the
+        user as compute_catalog_costs
+
+        The companies which are not allowed to the user are ignored.
+        """
+        pool = Pool()
+        User = pool.get('res.user')
+
+        transaction = Transaction()
+        if transaction.user:
+            user = User(transaction.user)
+            allowed = {c.id for c in user.companies}
+            if company_ids is None:
+                company_ids = sorted(allowed)
+            else:
+                company_ids = [c for c in company_ids if c in allowed]
+        return cls.compute_catalog_costs(recipe_ids, company_ids, batch_size)
+
+    @classmethod
+    def get_instrument_stats(cls, reset=False):
+        """Return the number of calls, the cumulative time and the number of
+        queries of the instrumented methods of the process indexed by name
+
+        The statistics are reset when reset is set.
+        """
+        return tool_get_instrument_stats(reset=reset)
+
+    @classmethod
+    def _compute_catalog_costs_parallel(
+            cls, recipe_ids, company_ids, batch_size, processes):
+        transaction = Transaction()
+        database_name = transaction.database.name
+        if database_name == ':memory:':
+            logger.warning(
+                'in memory database: recipes costed in a single process')
+            return cls.compute_catalog_costs(
+                recipe_ids, company_ids, batch_size, processes=1)
+
+        chunks = [[] for _ in range(processes)]
+        for group in cls._get_independent_recipe_groups(recipe_ids):
+            min(chunks, key=len).extend(group)
+        chunks = [c for c in chunks if c]
+
+        start = time.perf_counter()
+        costs = {}
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(len(chunks), mp_context=context,
+                initializer=_recost_initializer,
+                initargs=(database_name, {
+                        s: dict(config.items(s, raw=True))
+                        for s in config.sections()})) as executor:
+            for rows in executor.map(_recost_worker,
+                    [(database_name, transaction.user,
+                            dict(transaction.context), chunk, company_ids,
+                            batch_size) for chunk in chunks]):
+                for row in rows:
+                    costs[row[:2]] = row
+        logger.info('%s recipes costed with %s processes in %.3fs',
+            len(recipe_ids), len(chunks), time.perf_counter() - start)
+        return [costs[(c, r)] for c in company_ids for r in recipe_ids]
+
+    @classmethod
+    def _get_independent_recipe_groups(cls, recipe_ids):
+        """Return the recipe_ids grouped by connected subrecipe graph
+
+        The groups and their recipes are sorted by decreasing size and in
+        the order of recipe_ids.
+        """
+        pool = Pool()
+        SubRecipe = pool.get('dish_recipe.recipe.subrecipe')
+        subrecipe = SubRecipe.__table__()
+        cursor = Transaction().connection.cursor()
+
+        parents = {}
+
+        def find(recipe_id):
+            while parents.get(recipe_id, recipe_id) != recipe_id:
+                recipe_id = parents[recipe_id]
+            return recipe_id
+
+        cursor.execute(*subrecipe.select(
+                subrecipe.recipe, subrecipe.subrecipe))
+        for recipe_id, subrecipe_id in cursor:
+            root, sub_root = find(recipe_id), find(subrecipe_id)
+            if root != sub_root:
+                parents[max(root, sub_root)] = min(root, sub_root)
+
+        groups = {}
+        for recipe_id in recipe_ids:
+            groups.setdefault(find(recipe_id), []).append(recipe_id)
+        return sorted(groups.values(), key=len, reverse=True)
+
+    @classmethod
+    def _store_cost_rows(cls, rows):
+        pool = Pool()
+        Cost = pool.get('dish_recipe.recipe.cost')
+
+        recipe_ids = list({r[1] for r in rows})
+        to_delete = []
+        for sub_ids in grouped_slice(recipe_ids):
+            to_delete += Cost.search([
+                    ('recipe', 'in', list(sub_ids)),
+                    ])
+        Cost.delete(to_delete)
+        Cost.create([dict(zip(['company', 'recipe'] + STORED_COSTS,
+                        (company, recipe, *costs)))
+                for company, recipe, _, *costs in rows])
+
+    @classmethod
+    def _get_dependent_recipe_ids(cls, product_ids=None, recipe_ids=None):
+        """Return the ids of the recipes using product_ids as component or
+        recipe_ids as subrecipe and of the recipes using them as nested
+        subrecipe
+
+        The reverse graph is walked with one recursive query per slice of
+        ids.
+        """
+        pool = Pool()
+        Component = pool.get('dish_recipe.recipe.component')
+        SubRecipe = pool.get('dish_recipe.recipe.subrecipe')
+        cursor = Transaction().connection.cursor()
+
+        result = set()
+        for Model, column, ids in (
+                (Component, 'product', product_ids or []),
+                (SubRecipe, 'subrecipe', recipe_ids or [])):
+            for sub_ids in grouped_slice(list(ids)):
+                table = Model.__table__()
+                subrecipe = SubRecipe.__table__()
+                dependent = With('recipe', recursive=True)
+                dependent.query = table.select(table.recipe,
+                    where=reduce_ids(Column(table, column), sub_ids))
+                dependent.query |= subrecipe.join(dependent,
+                    condition=subrecipe.subrecipe == dependent.recipe
+                    ).select(subrecipe.recipe)
+                cursor.execute(*dependent.select(
+                        dependent.recipe, with_=[dependent]))
+                result.update(r for r, in cursor)
+        return result
+
+    @classmethod
+    def export_recipes(cls, recipes):
+        """Yield the values of recipes with their components, subrecipes,
+        prices and publish flags as accepted by import_recipes
+
+        The related records are referenced by name. Each recipe has a ref
+        unique in the export by which the exported subrecipes are referenced.
+        """
+        recipe_ids = [r.id for r in recipes]
+        exported = set(recipe_ids)
+        for sub_ids in grouped_slice(recipe_ids):
+            for recipe in cls.browse(sub_ids):
+                values = {f: getattr(recipe, f) for f in IMPORT_FIELDS}
+                values['ref'] = recipe.id
+                values['category'] = recipe.category.rec_name
+                values['product'] = (recipe.product
+                    and _product_key(recipe.product))
+                values['components'] = [{
+                        'product': _product_key(c.product),
+                        'quantity': c.quantity,
+                        'unit': c.unit.symbol,
+                        'waste': c.waste,
+                        'taxes': c.taxes,
+                        } for c in recipe.components]
+                values['subrecipes'] = []
+                for subrecipe in recipe.subrecipes:
+                    value = {
+                        'subrecipe': subrecipe.subrecipe.name,
+                        'quantity': subrecipe.quantity,
+                        }
+                    if subrecipe.subrecipe.id in exported:
+                        value['ref'] = subrecipe.subrecipe.id
+                    values['subrecipes'].append(value)
+                values['prices'] = [{
+                        'company': p.company.rec_name,
+                        'price': str(p.price),
+                        } for p in recipe.prices if p.price is not None]
+                values['publishes'] = [{
+                        'company': p.company.rec_name,
+                        'publish': p.publish,
+                        } for p in recipe.publishes]
+                yield values
+
+    @classmethod
+    def export_jsonl(cls, recipes, file):
+        "Write recipes to file as JSON Lines"
+        for values in cls.export_recipes(recipes):
+            file.write(json.dumps(values, sort_keys=True) + '\n')
+
+    @classmethod
+    def import_recipes(cls, values, batch_size=None):
+        """Create the recipes from the iterable of values as returned by
+        export_recipes
+
+        The values are consumed and created by batch and the related records
+        are looked up once per batch. The subrecipes are created once all
+        the recipes exist and the costs are updated at the end.
+        A subrecipe is referenced by the ref of a recipe of the values or
+        else by a name which must match a single recipe, those of the values
+        first.
+        """
+        if batch_size is None:
+            batch_size = Transaction().database.IN_MAX
+        lookups = {}
+        recipe_ids, subrecipes = [], []
+        with Transaction().set_context(_dish_recipe_defer_costs=True):
+            batch = []
+            for value in values:
+                batch.append(value)
+                if len(batch) >= batch_size:
+                    recipe_ids += cls._import_recipes(
+                        batch, lookups, subrecipes)
+                    batch = []
+            if batch:
+                recipe_ids += cls._import_recipes(batch, lookups, subrecipes)
+            cls._import_subrecipes(
+                recipe_ids, subrecipes, lookups.get('ref', {}))
+        recipes = cls.browse(recipe_ids)
+        cls.update_costs(recipes)
+        return recipes
+
+    @classmethod
+    def import_jsonl(cls, file, batch_size=None):
+        "Create the recipes from the JSON Lines of file"
+        return cls.import_recipes(
+            (json.loads(l) for l in file if l.strip()), batch_size=batch_size)
+
+    @classmethod
+    def _import_recipes(cls, batch, lookups, subrecipes):
+        pool = Pool()
+        Component = pool.get('dish_recipe.recipe.component')
+        Price = pool.get('dish_recipe.price')
+        Publish = pool.get('dish_recipe.publish')
+
+        def lookup(kind, keys):
+            return cls._import_lookup(lookups, kind, keys)
+        categories = lookup('category', {v['category'] for v in batch})
+        products = lookup('product',
+            {v['product'] for v in batch if v.get('product')}
+            | {c['product'] for v in batch for c in v.get('components', [])})
+        units = lookup('unit',
+            {c['unit'] for v in batch for c in v.get('components', [])})
+        companies = lookup('company',
+            {p['company'] for v in batch
+                for p in v.get('prices', []) + v.get('publishes', [])})
+
+        recipes = cls.create([dict(
+                    {f: v[f] for f in IMPORT_FIELDS if f in v},
+                    category=categories[v['category']],
+                    product=products.get(v.get('product')))
+                for v in batch])
+        refs = lookups.setdefault('ref', {})
+        components, prices, publishes = [], [], []
+        for recipe, value in zip(recipes, batch):
+            if value.get('ref') is not None:
+                if value['ref'] in refs:
+                    raise RecipeImportError(gettext(
+                            'dish_recipe.msg_import_ambiguous',
+                            kind='ref', names=value['ref']))
+                refs[value['ref']] = recipe.id
+            components.extend({
+                    'recipe': recipe.id,
+                    'product': products[c['product']],
+                    'quantity': c['quantity'],
+                    'unit': units[c['unit']],
+                    'waste': c.get('waste'),
+                    'taxes': c.get('taxes', False),
+                    } for c in value.get('components', []))
+            prices.extend({
+                    'recipe': recipe.id,
+                    'company': companies[p['company']],
+                    'price': Decimal(str(p['price'])),
+                    } for p in value.get('prices', []))
+            publishes.extend({
+                    'recipe': recipe.id,
+                    'company': companies[p['company']],
+                    'publish': p['publish'],
+                    } for p in value.get('publishes', []))
+            subrecipes.extend(
+                (recipe.id, s.get('ref'), s.get('subrecipe'), s['quantity'])
+                for s in value.get('subrecipes', []))
+        Component.create(components)
+        for Model, vlist in [(Price, prices), (Publish, publishes)]:
+            # Replace the default values created with the recipes
+            keys = {(v['recipe'], v['company']) for v in vlist}
+            Model.delete([r for r in Model.search([
+                            ('recipe', 'in', [r.id for r in recipes]),
+                            ('company', 'in', list({c for _, c in keys})),
+                            ])
+                    if (r.recipe.id, r.company.id) in keys])
+            Model.create(vlist)
+        return [r.id for r in recipes]
+
+    @classmethod
+    def _import_subrecipes(cls, recipe_ids, subrecipes, refs):
+        """Create the subrecipes referencing the recipes by the ref of the
+        imported recipes or else by name"""
+        pool = Pool()
+        SubRecipe = pool.get('dish_recipe.recipe.subrecipe')
+
+        cls._raise_import_missing('subrecipe', {str(r)
+                for _, r, _, _ in subrecipes
+                if r is not None and r not in refs})
+        names = {n for _, r, n, _ in subrecipes if r is None}
+        name2ids = {}
+        for sub_ids in grouped_slice(recipe_ids):
+            for recipe in cls.browse(sub_ids):
+                if recipe.name in names:
+                    name2ids.setdefault(recipe.name, set()).add(recipe.id)
+        missing = names - set(name2ids)
+        for sub_names in grouped_slice(list(missing)):
+            for recipe in cls.search([('name', 'in', list(sub_names))]):
+                name2ids.setdefault(recipe.name, set()).add(recipe.id)
+        cls._raise_import_missing('subrecipe', names - set(name2ids))
+        ambiguous = {n for n, ids in name2ids.items() if len(ids) > 1}
+        if ambiguous:
+            raise RecipeImportError(gettext('dish_recipe.msg_import_ambiguous',
+                    kind='subrecipe', names=', '.join(sorted(ambiguous))))
+
+        for sub_values in grouped_slice(subrecipes):
+            SubRecipe.create([{
+                        'recipe': recipe_id,
+                        'subrecipe': (refs[ref] if ref is not None
+                            else next(iter(name2ids[name]))),
+                        'quantity': quantity,
+                        } for recipe_id, ref, name, quantity in sub_values])
+
+    @classmethod
+    def _import_lookup(cls, lookups, kind, keys):
+        """Return the ids of the records of kind indexed by keys
+
+        Only the keys not yet in lookups are searched. A key matching more
+        than one record is an error.
+        """
+        pool = Pool()
+        Category = pool.get('dish_recipe.category')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        Company = pool.get('company.company')
+
+        known = lookups.setdefault(kind, {})
+        missing = list(set(keys) - set(known))
+        found = {}
+        for sub_keys in grouped_slice(missing):
+            sub_keys = list(sub_keys)
+            if kind == 'category':
+                leaves = list({k.split(' / ')[-1] for k in sub_keys})
+                records = [(c.rec_name, c.id)
+                    for c in Category.search([('name', 'in', leaves)])]
+            elif kind == 'product':
+                records = [(_product_key(p), p.id)
+                    for p in Product.search(['OR',
+                            ('code', 'in', sub_keys),
+                            ('name', 'in', sub_keys),
+                            ])]
+            elif kind == 'unit':
+                records = [(u.symbol, u.id)
+                    for u in Uom.search([('symbol', 'in', sub_keys)])]
+            elif kind == 'company':
+                records = [(c.rec_name, c.id)
+                    for c in Company.search([('party.name', 'in', sub_keys)])]
+            for key, id_ in records:
+                found.setdefault(key, set()).add(id_)
+        ambiguous = {k for k in missing if len(found.get(k, ())) > 1}
+        if ambiguous:
+            raise RecipeImportError(gettext('dish_recipe.msg_import_ambiguous',
+                    kind=kind, names=', '.join(sorted(ambiguous))))
+        known.update((k, found[k].pop()) for k in missing if k in found)
+        cls._raise_import_missing(kind, set(keys) - set(known))
+        return known
+
+    @classmethod
+    def _raise_import_missing(cls, kind, keys):
+        if keys:
+            raise RecipeImportError(gettext('dish_recipe.msg_import_missing',
+                    kind=kind, names=', '.join(sorted(keys))))
+
+    @classmethod
+    def create(cls, vlist):
+        recipes = super(Recipe, cls).create(vlist)
+        cls.update_costs(recipes, parents=False)
+        return recipes
+
+    @classmethod
+    def write(cls, *args):
+        super(Recipe, cls).write(*args)
+        cls._html_cache.clear()
+
     @classmethod
     def delete(cls, recipes):
         Attachment = Pool().get('ir.attachment')
         attachments = [a for h in recipes for a in h.attachments]
         Attachment.delete(attachments)
         super(Recipe, cls).delete(recipes)
+        cls._html_cache.clear()
+        cls._bom_cache.clear()
 
     @classmethod
     def copy(cls, recipes, default=None):
@@ -244,28 +1236,112 @@ class Recipe(ModelSQL, ModelView, sequence_ordered(), CompanyMultiValueMixin):
 
     @classmethod
     def validate(cls, recipes):
-        for recipe in recipes:
-            if recipe.product:
-                rcp = cls.search([
-                        ('product', '=', recipe.product.id),
-                        ('id', '!=', recipe.id),
-                    ])
-                if rcp:
-                    raise UserError(
-                        gettext('dish_recipe_product.msg_product_selected',
-                            product=product.rec_name,
-                            recipe=recipe.rec_name,
-                            rcp=rcp.rec_name))
+        cls.check_products(recipes)
         super(Recipe, cls).validate(recipes)
 
+    @classmethod
+    def check_products(cls, recipes):
+        "Check that the products belong to only one active recipe"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        product_ids = list({r.product.id for r in recipes if r.product})
+        product2recipes = {}
+        for sub_ids in grouped_slice(product_ids):
+            cursor.execute(*table.select(table.product, table.id,
+                    where=reduce_ids(table.product, sub_ids)
+                    & (table.active == Literal(True)),
+                    order_by=[table.product, table.id]))
+            for product_id, recipe_id in cursor:
+                product2recipes.setdefault(product_id, []).append(recipe_id)
+
+        pairs = {}
+        for recipe in recipes:
+            if not recipe.product:
+                continue
+            for other_id in product2recipes.get(recipe.product.id, []):
+                if other_id != recipe.id:
+                    key = tuple(sorted((recipe.id, other_id)))
+                    pairs.setdefault(key, (recipe, other_id))
+        if pairs:
+            others = {r.id: r for r in cls.browse(
+                    list({o for _, o in pairs.values()}))}
+            raise RecipeProductError('\n'.join(
+                    gettext('dish_recipe.msg_product_selected',
+                        product=recipe.product.rec_name,
+                        recipe=recipe.rec_name,
+                        rcp=others[other_id].rec_name)
+                    for recipe, other_id in pairs.values()))
+
+
+class RecipeCostUpdateMixin(object):
+    """Update the stored costs of the recipes of the records and clear their
+    bill of materials"""
+    __slots__ = ()
+    _recipe_cost_parents = True
+    _recipe_bom = True
+
+    @classmethod
+    def _update_recipe_costs(cls, recipes):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Recipe.update_costs([r for r in recipes if r],
+            parents=cls._recipe_cost_parents)
+        if cls._recipe_bom:
+            Recipe._bom_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(RecipeCostUpdateMixin, cls).create(vlist)
+        cls._update_recipe_costs([r.recipe for r in records])
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        ids = [r.id for r in sum(args[::2], [])]
+        recipes = [r.recipe for r in cls.browse(ids)]
+        super(RecipeCostUpdateMixin, cls).write(*args)
+        recipes += [r.recipe for r in cls.browse(ids)]
+        cls._update_recipe_costs(recipes)
+
+    @classmethod
+    def delete(cls, records):
+        recipes = [r.recipe for r in records]
+        super(RecipeCostUpdateMixin, cls).delete(records)
+        cls._update_recipe_costs(recipes)
+
 
-class RecipePrice(ModelSQL, CompanyValueMixin):
+class RecipePrice(RecipeCostUpdateMixin, ModelSQL, CompanyValueMixin):
     "Recipe Price"
     __name__ = 'dish_recipe.price'
+    _recipe_cost_parents = False
+    _recipe_bom = False
     recipe = fields.Many2One(
         'dish_recipe.recipe', 'Recipe', ondelete='CASCADE')
     price = fields.Numeric("Price", digits=price_digits)
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        records = super(RecipePrice, cls).create(vlist)
+        Recipe._html_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        super(RecipePrice, cls).write(*args)
+        Recipe._html_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        super(RecipePrice, cls).delete(records)
+        Recipe._html_cache.clear()
+
 
 class RecipePublish(ModelSQL, CompanyValueMixin):
     "Recipe Publish"
@@ -275,7 +1351,31 @@ class RecipePublish(ModelSQL, CompanyValueMixin):
     publish = fields.Boolean("Publish")
 
 
-class SubRecipe(ModelSQL, ModelView):
+class RecipeCost(ModelSQL, CompanyValueMixin):
+    "Recipe Cost"
+    __name__ = 'dish_recipe.recipe.cost'
+    recipe = fields.Many2One(
+        'dish_recipe.recipe', 'Recipe', ondelete='CASCADE', required=True)
+    cost = fields.Numeric('Cost', digits=price_digits)
+    cost_last = fields.Numeric('Last Cost', digits=price_digits)
+    percentage = fields.Numeric('Percentage', digits=price_digits)
+    percentage_last = fields.Numeric('Percentage', digits=price_digits)
+
+    @classmethod
+    def __setup__(cls):
+        super(RecipeCost, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('recipe_company_uniq', Unique(t, t.recipe, t.company),
+                'dish_recipe.msg_recipe_cost_recipe_company_unique'),
+            ]
+        cls._sql_indexes.add(
+            Index(t,
+                (t.recipe, Index.Equality()),
+                (t.company, Index.Equality())))
+
+
+class SubRecipe(RecipeCostUpdateMixin, ModelSQL, ModelView):
     'Sub Recipe'
     __name__ = 'dish_recipe.recipe.subrecipe'
 
@@ -300,41 +1400,93 @@ class SubRecipe(ModelSQL, ModelView):
         'get_cost')
     total_cost = fields.Function(fields.Numeric('Total Cost',
             digits=price_digits),
-        'get_total_cost')
+        'get_cost')
     total_cost_last = fields.Function(fields.Numeric('Total Last Cost',
             digits=price_digits),
-        'get_total_cost')
+        'get_cost')
+
+    @classmethod
+    def __setup__(cls):
+        super(SubRecipe, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.subrecipe, Index.Equality())))
 
     def get_unit_digits(self, name=None):
         return price_digits[1]
 
-    def get_cost(self, name=None):
-        if not self.subrecipe:
-            return Decimal('0.0')
-        return getattr(self, name)
+    @classmethod
+    def get_cost(cls, subrecipes, names):
+        costs = cls.get_costs(subrecipes)
+        result = {}
+        for name in names:
+            result[name] = {s.id: v[name]
+                for s, v in zip(subrecipes, costs)}
+        return result
 
-    def get_total_cost(self, name=None):
-        if not self.quantity:
-            return Decimal('0.0')
-        if name == 'total_cost':
-            field = 'cost'
-        else:
-            field = 'cost_last'
-        return getattr(self, field) * Decimal(self.quantity)
+    @classmethod
+    def get_costs(cls, subrecipes):
+        "Return the cost values of subrecipes in the same order"
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+
+        recipe_costs = Recipe.get_costs(
+            list({s.subrecipe for s in subrecipes if s.subrecipe}))
+        result = []
+        for subrecipe in subrecipes:
+            costs = None
+            if subrecipe.subrecipe:
+                costs = recipe_costs[subrecipe.subrecipe.id]
+            result.append(cls._line_costs(subrecipe.quantity, costs))
+        return result
+
+    @staticmethod
+    def _line_costs(quantity, recipe_costs):
+        costs = {}
+        for field in ('cost', 'cost_last'):
+            cost = Decimal('0.0')
+            if recipe_costs is not None:
+                cost = recipe_costs[field]
+            costs[field] = cost
+            if quantity:
+                costs['total_' + field] = cost * Decimal(quantity)
+            else:
+                costs['total_' + field] = Decimal('0.0')
+        return costs
+
+    @classmethod
+    def validate(cls, subrecipes):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        super(SubRecipe, cls).validate(subrecipes)
+        _, lines = Recipe._get_cost_graph(
+            {s.recipe.id for s in subrecipes}, [])
+        Recipe._sort_cost_graph({i: [l.subrecipe.id for l in l_lines]
+                for i, l_lines in lines.items()})
 
     @fields.depends('quantity', 'subrecipe')
     def on_change_subrecipe(self):
-        self.cost = self.get_cost(name='cost')
-        self.cost_last = self.get_cost(name='cost_last')
-        self.total_cost = self.get_total_cost(name='total_cost')
-        self.total_cost_last = self.get_total_cost(name='total_cost_last')
+        costs, = self.get_costs([self])
+        for name, value in costs.items():
+            setattr(self, name, value)
 
-    @fields.depends(methods=['on_change_subrecipe'])
+    @fields.depends('quantity', 'cost', 'cost_last',
+        methods=['on_change_subrecipe'])
     def on_change_quantity(self):
-        self.on_change_subrecipe()
+        cost = getattr(self, 'cost', None)
+        cost_last = getattr(self, 'cost_last', None)
+        if cost is None or cost_last is None:
+            self.on_change_subrecipe()
+            return
+        costs = self._line_costs(self.quantity, {
+                'cost': cost,
+                'cost_last': cost_last,
+                })
+        for name, value in costs.items():
+            setattr(self, name, value)
 
 
-class RecipeComponent(ModelSQL, ModelView):
+class RecipeComponent(RecipeCostUpdateMixin, ModelSQL, ModelView):
     'Recipe Component'
     __name__ = 'dish_recipe.recipe.component'
 
@@ -361,16 +1513,23 @@ class RecipeComponent(ModelSQL, ModelView):
     taxes = fields.Boolean('Include taxes')
     cost = fields.Function(fields.Numeric('Cost',
             digits=price_digits),
-        'on_change_with_cost')
+        'get_cost')
     cost_last = fields.Function(fields.Numeric('Last Cost',
             digits=price_digits),
-        'on_change_with_cost_last')
+        'get_cost')
     total_cost = fields.Function(fields.Numeric('Total Cost',
             digits=price_digits),
-        'on_change_with_total_cost')
+        'get_cost')
     total_cost_last = fields.Function(fields.Numeric('Total Last Cost',
             digits=price_digits),
-        'on_change_with_total_cost_last')
+        'get_cost')
+
+    @classmethod
+    def __setup__(cls):
+        super(RecipeComponent, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.product, Index.Equality())))
 
     @fields.depends('unit')
     def on_change_with_unit_digits(self, name=None):
@@ -405,11 +1564,80 @@ class RecipeComponent(ModelSQL, ModelView):
         return self._get_total_cost(
                 'cost_last', self.quantity, self.waste)
 
+    @classmethod
+    def get_cost(cls, components, names):
+        costs = cls.get_costs(components)
+        result = {}
+        for name in names:
+            result[name] = {c.id: v[name]
+                for c, v in zip(components, costs)}
+        return result
+
+    @classmethod
+    def get_costs(cls, components):
+        """Return the cost values of components in the same order
+
+        Cost prices and last purchase costs are read once for all the
+        products of the components and the taxes of all the components which
+        include them are computed together.
+        """
+        products = list({c.product for c in components if c.product})
+        cost_prices = cls._get_cost_prices(products)
+        last_costs = cls._get_last_costs(products,
+            date=Transaction().context.get('_dish_recipe_cost_date'))
+        result = []
+        converted, conversions = [], []
+        for component in components:
+            product, unit = component.product, component.unit
+            costs = {
+                'cost': Decimal('0.0'),
+                'cost_last': Decimal('0.0'),
+                }
+            if product and unit:
+                l_cost, l_unit = last_costs.get(product.id, (None, None))
+                converted.append((component, costs))
+                conversions.append(
+                    (cost_prices.get(product.id), product.default_uom, unit))
+                conversions.append((l_cost, l_unit, unit))
+            result.append(costs)
+
+        taxed = []
+        converted_costs = iter(cls._convert_costs(conversions))
+        for component, costs in converted:
+            costs['cost'] = next(converted_costs)
+            costs['cost_last'] = next(converted_costs)
+            if component.taxes:
+                taxed.append((component, costs))
+
+        names = ('cost', 'cost_last')
+        tax_amounts = iter(cls._compute_taxes_batch(
+                [(c.product, v[f]) for c, v in taxed for f in names]))
+        for component, costs in taxed:
+            for field in names:
+                costs[field] += next(tax_amounts)
+
+        for component, costs in zip(components, result):
+            costs['total_cost'] = cls._apply_quantity(
+                costs['cost'], component.quantity, component.waste)
+            costs['total_cost_last'] = cls._apply_quantity(
+                costs['cost_last'], component.quantity, component.waste)
+        return result
+
     def _get_total_cost(self, name, quantity, waste):
+        return self._apply_quantity(getattr(self, name), quantity, waste)
+
+    def _apply_waste(self, quantity):
+        "Return quantity increased by the waste percentage of the component"
+        if self.waste and (self.waste > 0 and self.waste < 100):
+            quantity += quantity * self.waste / 100
+        return quantity
+
+    @staticmethod
+    def _apply_quantity(cost, quantity, waste):
         if not quantity:
             return Decimal('0.0')
-        total = getattr(self, name) * Decimal(quantity)
-        if self.waste and (waste > 0 and waste < 100):
+        total = cost * Decimal(quantity)
+        if waste and (waste > 0 and waste < 100):
             waste_t = total * Decimal((waste / 100))
             total += waste_t
         return total
@@ -417,92 +1645,193 @@ class RecipeComponent(ModelSQL, ModelView):
     def _calculate_cost(self, name, product, unit, include_tax):
         if not product or not unit:
             return Decimal('0.0')
-        Uom = Pool().get('product.uom')
-        cost = None
         if name == 'cost':
-            cost = Uom.compute_price(
-                product.default_uom,
-                product.cost_price,
-                unit)
+            cost = self._convert_cost(product.cost_price,
+                product.default_uom, unit)
         elif name == 'cost_last':
             l_cost, l_unit = self._get_last_cost(product)
-            if l_unit is not None:
-                cost = Uom.compute_price(
-                    l_unit,
-                    l_cost,
-                    unit)
-
-        if cost is None:
-            return Decimal('0.0')
-        res = cost
+            cost = self._convert_cost(l_cost, l_unit, unit)
+        else:
+            return
         if include_tax:
-            tax_amount = self._compute_taxes(product, cost)
-            res = cost + tax_amount
-        return res
+            cost += self._compute_taxes(product, cost)
+        return cost
 
-    def _get_last_cost(self, product,
-            date=None, company=None):
-        if not product:
-            return Decimal('0.0')
+    @classmethod
+    def _convert_cost(cls, cost, from_unit, unit):
+        return cls._convert_costs([(cost, from_unit, unit)])[0]
+
+    @classmethod
+    @tool_instrument('dish_recipe.recipe.component._convert_costs')
+    def _convert_costs(cls, values):
+        """Return the costs of values, a list of (cost, from_unit, unit),
+        converted to unit
+
+        The conversion between two units is computed once per transaction
+        and gives the same result as Uom.compute_price.
+        """
+        Uom = Pool().get('product.uom')
+        result = []
+        for cost, from_unit, unit in values:
+            if from_unit is None:
+                result.append(Decimal('0.0'))
+                continue
+            conversion = None
+            if cost and unit is not None:
+                conversion = cls._get_uom_conversion(from_unit, unit)
+            if conversion is not None:
+                for operation, value in conversion:
+                    cost = operation(cost, value)
+            else:
+                cost = Uom.compute_price(from_unit, cost, unit)
+            if cost is None:
+                cost = Decimal('0.0')
+            result.append(cost)
+        return result
+
+    @classmethod
+    def _get_uom_conversion(cls, from_unit, unit):
+        """Return the operations converting a price from from_unit to unit
+        or None if they are not in the same category"""
+        cache = tool_get_transaction_cache('product.uom.conversion')
+        key = (from_unit.id, unit.id)
+        if key in cache:
+            return cache[key]
+        format_ = '%%.%df' % uom_conversion_digits[1]
+        conversion = None
+        if from_unit.category.id == unit.category.id:
+            conversion = []
+            for uom, from_ in ((from_unit, True), (unit, False)):
+                if uom.accurate_field == 'factor':
+                    conversion.append((
+                            truediv if from_ else mul,
+                            Decimal(format_ % uom.factor)))
+                else:
+                    conversion.append((
+                            mul if from_ else truediv,
+                            Decimal(format_ % uom.rate)))
+        cache[key] = conversion
+        return conversion
+
+    @classmethod
+    @tool_instrument('dish_recipe.recipe.component._get_cost_prices')
+    def _get_cost_prices(cls, products, company=None):
         pool = Pool()
-        Line = pool.get('account.invoice.line')
+        CostPrice = pool.get('product.cost_price')
+        cost_price = CostPrice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if company is None:
+            company = Transaction().context.get('company')
+        result = {}
+        if company is None:
+            return result
+        for sub_ids in grouped_slice([p.id for p in products]):
+            cursor.execute(*cost_price.select(
+                    cost_price.product, cost_price.cost_price,
+                    where=reduce_ids(cost_price.product, sub_ids)
+                    & (cost_price.company == company)))
+            result.update(cursor)
+        return result
+
+    @classmethod
+    @tool_instrument('dish_recipe.recipe.component._get_last_costs')
+    def _get_last_costs(cls, products, date=None, company=None):
+        """Return the last unit price and unit invoiced for products
+
+        The result is a dictionary indexed by product id, products never
+        invoiced are missing. Without date the stored last costs are used
+        otherwise they are computed from the invoices up to the date.
+        """
+        pool = Pool()
+        LastCost = pool.get('dish_recipe.product.last_cost')
+        Uom = pool.get('product.uom')
 
         if company is None:
             company = Transaction().context.get('company')
-        domain = [
-                ('invoice.company', '=', company),
-                ('invoice.state', 'in', ['posted', 'paid']),
-                ('type', '=', 'line'),
-                ('product', '=', product.id),
-                ('unit_price', '>', 0),
-            ]
         if date:
-            domain.append(('invoice.invoice_date', '<=', date))
+            rows = {p: (c, u) for p, (c, u, _) in
+                LastCost.compute_last_costs(
+                    [p.id for p in products], company, date=date).items()}
+        else:
+            rows = LastCost.get_last_costs(products, company=company)
+
+        units = {u.id: u for u in Uom.browse(
+                list({u for _, u in rows.values()}))}
+        return {p: (c, units[u]) for p, (c, u) in rows.items()}
 
-        lines = Line.search(domain,
-            order=[('invoice.invoice_date', 'DESC'), ('id', 'DESC')],
-            limit=1)
-        if lines:
-            return lines[0].unit_price, lines[0].unit
-        return None, None
+    @classmethod
+    @tool_instrument('dish_recipe.recipe.component._get_last_cost')
+    def _get_last_cost(cls, product,
+            date=None, company=None):
+        if not product:
+            return None, None
+        return cls._get_last_costs([product],
+            date=date, company=company).get(product.id, (None, None))
 
+    @tool_instrument('dish_recipe.recipe.component._compute_taxes')
     def _compute_taxes(self, product, cost):
+        return self._compute_taxes_batch([(product, cost)])[0]
+
+    @classmethod
+    @tool_instrument('dish_recipe.recipe.component._compute_taxes_batch')
+    def _compute_taxes_batch(cls, values):
+        """Return the supplier tax amounts for a list of (product, cost)
+        in the same order
+
+        The taxes are those at the cost date of the context or today. The
+        amounts are cached for the transaction by product, taxes, cost,
+        currency and date.
+        """
         pool = Pool()
-        Tax = pool.get('account.tax')
         Company = pool.get('company.company')
+        Date = pool.get('ir.date')
 
-        tax_ids = []
-        taxes = {}
+        date = (Transaction().context.get('_dish_recipe_cost_date')
+            or Date.today())
         currency = None
-
         company_id = Transaction().context.get('company', None)
         if company_id is not None:
             currency = Company(company_id).currency
+        cache = tool_get_transaction_cache(cls.__name__ + '.taxes')
 
-        print(product.name)
-
-        for tax in product.supplier_taxes_used:
-            tax_ids.append(tax.id)
+        result = []
+        for product, cost in values:
+            # The supplier taxes exist only with account_product
+            taxes = getattr(product, 'supplier_taxes_used', None) or []
+            if not taxes:
+                result.append(Decimal('0.0'))
+                continue
+            key = (product.id, tuple(sorted(t.id for t in taxes)), cost,
+                currency.id if currency else None, date)
+            if key not in cache:
+                cache[key] = cls._get_tax_amount(
+                    taxes, cost, currency, date)
+            result.append(cache[key])
+        return result
 
-        l_taxes = Tax.compute(Tax.browse(tax_ids), cost, 1, None)
-        #print(l_taxes)
+    @classmethod
+    def _get_tax_amount(cls, taxes, cost, currency, date):
+        pool = Pool()
+        Tax = pool.get('account.tax')
 
-        for tax in l_taxes:
-            taxline = self._compute_tax_line(**tax)
+        tax_lines = {}
+        for tax in Tax.compute(taxes, cost, 1, date):
+            taxline = cls._compute_tax_line(**tax)
             # Base must always be rounded per line as there will be one
             # tax line per taxable_lines
             if currency is not None:
                 taxline['base'] = currency.round(taxline['base'])
-            if taxline not in taxes:
-                taxes[taxline] = taxline
+            if taxline not in tax_lines:
+                tax_lines[taxline] = taxline
             else:
-                taxes[taxline]['base'] += taxline['base']
-                taxes[taxline]['amount'] += taxline['amount']
+                tax_lines[taxline]['base'] += taxline['base']
+                tax_lines[taxline]['amount'] += taxline['amount']
 
-        self._round_taxes(taxes, currency)
+        cls._round_taxes(tax_lines, currency)
         res = Decimal('0.0')
-        for tx in taxes.items():
-            res = tx[0]['amount']
+        for taxline in tax_lines.values():
+            res += taxline['amount']
         return res
 
     @staticmethod
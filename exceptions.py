@@ -0,0 +1,20 @@
+# This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.exceptions import UserError
+from trytond.model.exceptions import ValidationError
+
+
+class RecipeCycleError(ValidationError):
+    pass
+
+
+class RecipeProductError(ValidationError):
+    pass
+
+
+class RecipeImportError(UserError):
+    pass
+
+
+class SnapshotDateError(UserError):
+    pass
@@ -0,0 +1,115 @@
+# This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import io
+
+try:
+    import PIL
+    from PIL import Image
+except ImportError:
+    PIL = None
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import ModelSQL, fields, Unique
+from trytond.model.modelsql import SQLConstraintError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+if config.getboolean('attachment', 'filestore', default=True):
+    file_id = 'image_id'
+    store_prefix = config.get('attachment', 'store_prefix', default=None)
+else:
+    file_id = None
+    store_prefix = None
+
+# Maximal width and height in pixels of the image sizes
+IMAGE_SIZES = {
+    'thumb': 200,
+    'medium': 800,
+    'full': None,
+    }
+
+
+class ImageVariant(ModelSQL):
+    "Recipe Image Variant"
+    __name__ = 'dish_recipe.image.variant'
+    attachment = fields.Many2One('ir.attachment', 'Attachment',
+        required=True, ondelete='CASCADE')
+    size = fields.Char('Size', required=True)
+    checksum = fields.Char('Checksum',
+        help='The checksum of the attachment the image was resized from.')
+    image = fields.Binary('Image', file_id=file_id, store_prefix=store_prefix)
+    image_id = fields.Char('Image ID', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ImageVariant, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('attachment_size_uniq', Unique(t, t.attachment, t.size),
+                'dish_recipe.msg_image_variant_attachment_size_unique'),
+            ]
+
+    @classmethod
+    def get_image(cls, attachment_id, checksum, size):
+        """Return the data of the attachment resized to size
+
+        The resized data is stored on first request and reused as long as
+        the checksum of the attachment does not change.
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        if size not in IMAGE_SIZES:
+            raise ValueError("Invalid size")
+        if IMAGE_SIZES[size] is None or not PIL:
+            return Attachment(attachment_id).data
+
+        checksum = str(checksum)
+        variants = cls.search([
+                ('attachment', '=', attachment_id),
+                ('size', '=', size),
+                ], limit=1)
+        if variants and variants[0].checksum == checksum:
+            return variants[0].image
+
+        data = Attachment(attachment_id).data
+        image = cls._resize(data, IMAGE_SIZES[size])
+        if image is data:
+            # The attachment is already within the size
+            return image
+        try:
+            with Transaction().new_transaction():
+                # Store variant only if attachment is already committed
+                if Attachment.search([('id', '=', attachment_id)]):
+                    if variants:
+                        cls.write([cls(variants[0].id)], {
+                                'checksum': checksum,
+                                'image': image,
+                                })
+                    else:
+                        cls.create([{
+                                    'attachment': attachment_id,
+                                    'size': size,
+                                    'checksum': checksum,
+                                    'image': image,
+                                    }])
+        except (backend.DatabaseIntegrityError, SQLConstraintError):
+            # The variant was created by a concurrent request
+            pass
+        return image
+
+    @classmethod
+    def _resize(cls, data, size):
+        if not data:
+            return data
+        try:
+            img = Image.open(io.BytesIO(data))
+            if img.width <= size and img.height <= size:
+                return data
+            format_ = img.format
+            img.thumbnail((size, size))
+            result = io.BytesIO()
+            img.save(result, format=format_, optimize=True)
+        except (OSError, ValueError):
+            return data
+        return result.getvalue()
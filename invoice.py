@@ -0,0 +1,37 @@
+# This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+
+class Invoice(metaclass=PoolMeta):
+    __name__ = 'account.invoice'
+
+    @classmethod
+    def post(cls, invoices):
+        super(Invoice, cls).post(invoices)
+        cls._update_dish_recipe_last_costs(invoices)
+
+    @classmethod
+    def post_batch(cls, invoices):
+        super(Invoice, cls).post_batch(invoices)
+        cls._update_dish_recipe_last_costs(invoices)
+
+    @classmethod
+    def paid(cls, invoices):
+        super(Invoice, cls).paid(invoices)
+        cls._update_dish_recipe_last_costs(invoices)
+
+    @classmethod
+    def cancel(cls, invoices):
+        super(Invoice, cls).cancel(invoices)
+        cls._update_dish_recipe_last_costs(invoices)
+
+    @classmethod
+    def _update_dish_recipe_last_costs(cls, invoices):
+        pool = Pool()
+        LastCost = pool.get('dish_recipe.product.last_cost')
+        # The last costs are maintained for any user allowed to process
+        # the invoices
+        with Transaction().set_context(_check_access=False):
+            LastCost.update_invoices(invoices)
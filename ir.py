@@ -0,0 +1,73 @@
+# This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.model import Index
+from trytond.pool import Pool, PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+                ('dish_recipe.recipe|recost_catalog', "Recost Recipes"),
+                ('dish_recipe.recipe|snapshot_costs',
+                    "Snapshot Recipe Costs"),
+                ])
+
+
+class RecipeHTMLCacheMixin(object):
+    "Clear the rendered html of recipes when the records change"
+    __slots__ = ()
+
+    @classmethod
+    def _clear_recipe_html(cls, records):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        if any(cls._is_recipe_html(r) for r in records):
+            Recipe._html_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(RecipeHTMLCacheMixin, cls).create(vlist)
+        cls._clear_recipe_html(records)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        records = sum(args[::2], [])
+        cls._clear_recipe_html(records)
+        super(RecipeHTMLCacheMixin, cls).write(*args)
+        cls._clear_recipe_html(cls.browse([r.id for r in records]))
+
+    @classmethod
+    def delete(cls, records):
+        cls._clear_recipe_html(records)
+        super(RecipeHTMLCacheMixin, cls).delete(records)
+
+
+class Translation(RecipeHTMLCacheMixin, metaclass=PoolMeta):
+    __name__ = 'ir.translation'
+
+    @classmethod
+    def _is_recipe_html(cls, translation):
+        return (translation.type == 'model'
+            and translation.name.startswith('dish_recipe.recipe,'))
+
+
+class Attachment(RecipeHTMLCacheMixin, metaclass=PoolMeta):
+    __name__ = 'ir.attachment'
+
+    @classmethod
+    def __setup__(cls):
+        super(Attachment, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.resource, Index.Equality()),
+                (t.name, Index.Equality())))
+
+    @classmethod
+    def _is_recipe_html(cls, attachment):
+        return str(attachment.resource).startswith('dish_recipe.recipe,')
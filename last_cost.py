@@ -0,0 +1,242 @@
+# This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, fields, Index, Unique
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.modules.product import price_digits
+from sql import Window
+from sql.functions import CurrentTimestamp, RowNumber
+
+
+class ProductLastCost(ModelSQL, ModelView):
+    "Product Last Cost"
+    __name__ = 'dish_recipe.product.last_cost'
+    company = fields.Many2One('company.company', 'Company',
+        required=True, ondelete='CASCADE', readonly=True)
+    product = fields.Many2One('product.product', 'Product',
+        required=True, ondelete='CASCADE', readonly=True)
+    unit_price = fields.Numeric('Unit Price', digits=price_digits,
+        required=True, readonly=True)
+    unit = fields.Many2One('product.uom', 'Unit', required=True,
+        readonly=True)
+    invoice_date = fields.Date('Invoice Date', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ProductLastCost, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_product_uniq', Unique(t, t.company, t.product),
+                'dish_recipe.msg_last_cost_company_product_unique'),
+            ]
+        cls._sql_indexes.add(
+            Index(t,
+                (t.company, Index.Equality()),
+                (t.product, Index.Equality())))
+        cls._order = [
+            ('invoice_date', 'DESC'),
+            ('id', 'DESC'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+        super(ProductLastCost, cls).__register__(module_name)
+        if not exist:
+            cls._fill_last_costs()
+
+    @classmethod
+    def _fill_last_costs(cls):
+        "Fill the stored last costs of all the companies from the invoices"
+        pool = Pool()
+        Company = pool.get('company.company')
+        try:
+            Invoice = pool.get('account.invoice')
+        except KeyError:
+            return
+        if not backend.TableHandler.table_exist(Invoice._table):
+            return
+        table = cls.__table__()
+        company = Company.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*company.select(company.id))
+        for company_id, in cursor.fetchall():
+            costs = cls.compute_last_costs(
+                cls._get_invoiced_products(company_id), company_id)
+            rows = [[company_id, product_id, unit_price, unit_id,
+                    invoice_date, 0, CurrentTimestamp()]
+                for product_id, (unit_price, unit_id, invoice_date)
+                in costs.items()]
+            for sub_rows in grouped_slice(rows):
+                cursor.execute(*table.insert([
+                            table.company, table.product, table.unit_price,
+                            table.unit, table.invoice_date, table.create_uid,
+                            table.create_date,
+                            ], list(sub_rows)))
+
+    @classmethod
+    def get_last_costs(cls, products, company=None):
+        """Return the stored last unit price and unit id of products
+        indexed by product id"""
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if company is None:
+            company = Transaction().context.get('company')
+        result = {}
+        for sub_ids in grouped_slice([p.id for p in products]):
+            cursor.execute(*table.select(
+                    table.product, table.unit_price, table.unit,
+                    where=reduce_ids(table.product, sub_ids)
+                    & (table.company == company)))
+            for product_id, unit_price, unit_id in cursor:
+                result[product_id] = (unit_price, unit_id)
+        return result
+
+    @classmethod
+    def compute_last_costs(cls, product_ids, company, date=None):
+        """Return the last unit price, unit id and invoice date of products
+        from the posted or paid supplier invoices indexed by product id
+
+        All the products are looked up with a single query per slice of ids
+        using a window function. Without account_invoice, there is no last
+        cost.
+        """
+        pool = Pool()
+        try:
+            Line = pool.get('account.invoice.line')
+            Invoice = pool.get('account.invoice')
+        except KeyError:
+            return {}
+        line = Line.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        rank = RowNumber(window=Window([line.product],
+                order_by=[invoice.invoice_date.desc, line.id.desc]))
+        result = {}
+        for sub_ids in grouped_slice(product_ids):
+            where = (reduce_ids(line.product, sub_ids)
+                & (invoice.company == company)
+                & (invoice.type == 'in')
+                & invoice.state.in_(['posted', 'paid'])
+                & (line.type == 'line')
+                & (line.unit_price > 0))
+            if date:
+                where &= invoice.invoice_date <= date
+            query = line.join(invoice,
+                condition=line.invoice == invoice.id
+                ).select(line.product, line.unit_price, line.unit,
+                    invoice.invoice_date, rank.as_('rank'),
+                    where=where)
+            cursor.execute(*query.select(
+                    query.product, query.unit_price, query.unit,
+                    query.invoice_date,
+                    where=query.rank == 1))
+            for product_id, unit_price, unit_id, invoice_date in cursor:
+                result[product_id] = (unit_price, unit_id, invoice_date)
+        return result
+
+    @classmethod
+    def update_last_costs(cls, product_ids, company):
+        "Recompute the stored last costs of products for the company"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Recipe = pool.get('dish_recipe.recipe')
+        product_ids = list(set(product_ids))
+        costs = cls.compute_last_costs(product_ids, company)
+        to_delete = []
+        for sub_ids in grouped_slice(product_ids):
+            to_delete += cls.search([
+                    ('company', '=', company),
+                    ('product', 'in', list(sub_ids)),
+                    ])
+        cls.delete(to_delete)
+        cls.create([{
+                    'company': company,
+                    'product': product_id,
+                    'unit_price': unit_price,
+                    'unit': unit_id,
+                    'invoice_date': invoice_date,
+                    }
+                for product_id, (unit_price, unit_id, invoice_date)
+                in costs.items()])
+        Recipe.update_product_costs(Product.browse(product_ids))
+
+    @classmethod
+    def update_invoices(cls, invoices):
+        "Update the stored last costs of the products of supplier invoices"
+        products = {}
+        for invoice in invoices:
+            if invoice.type != 'in':
+                continue
+            products.setdefault(invoice.company.id, set()).update(
+                l.product.id for l in invoice.lines
+                if l.type == 'line' and l.product)
+        for company, product_ids in products.items():
+            cls.update_last_costs(product_ids, company)
+
+    @classmethod
+    def rebuild(cls, companies):
+        "Rebuild the stored last costs of companies from invoice history"
+        for company in companies:
+            product_ids = cls._get_invoiced_products(company.id)
+            cls.delete(cls.search([('company', '=', company.id)]))
+            cls.update_last_costs(product_ids, company.id)
+
+    @classmethod
+    def _get_invoiced_products(cls, company):
+        "Return the ids of the products of the supplier invoices of company"
+        pool = Pool()
+        try:
+            Line = pool.get('account.invoice.line')
+            Invoice = pool.get('account.invoice')
+        except KeyError:
+            return []
+        line = Line.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*line.join(invoice,
+                condition=line.invoice == invoice.id
+                ).select(line.product,
+                where=(invoice.company == company)
+                & (invoice.type == 'in')
+                & (line.product != None),
+                group_by=[line.product]))
+        return [p for p, in cursor]
+
+
+class RebuildLastCostStart(ModelView):
+    "Rebuild Last Cost Start"
+    __name__ = 'dish_recipe.product.last_cost.rebuild.start'
+    companies = fields.Many2Many('company.company', None, None,
+        'Companies', required=True)
+
+    @staticmethod
+    def default_companies():
+        company = Transaction().context.get('company')
+        if company is not None:
+            return [company]
+        return []
+
+
+class RebuildLastCost(Wizard):
+    "Rebuild Last Cost"
+    __name__ = 'dish_recipe.product.last_cost.rebuild'
+    start = StateView('dish_recipe.product.last_cost.rebuild.start',
+        'dish_recipe.last_cost_rebuild_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Rebuild', 'rebuild', 'tryton-ok', default=True),
+            ])
+    rebuild = StateTransition()
+
+    def transition_rebuild(self):
+        pool = Pool()
+        LastCost = pool.get('dish_recipe.product.last_cost')
+        LastCost.rebuild(self.start.companies)
+        return 'end'
@@ -1,10 +1,48 @@
 # This file is part of dish_recipe_product module.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from . tools import tool_instrument
 
 
 class Product(metaclass=PoolMeta):
     __name__ = 'product.product'
     recipe = fields.One2Many('dish_recipe.recipe',
         'product', 'Recipe', readonly=True)
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+
+    @classmethod
+    @tool_instrument('product.uom.compute_price')
+    def compute_price(cls, from_uom, price, to_uom, factor=None, rate=None):
+        return super(Uom, cls).compute_price(
+            from_uom, price, to_uom, factor=factor, rate=rate)
+
+
+class ProductCostPrice(metaclass=PoolMeta):
+    __name__ = 'product.cost_price'
+
+    @classmethod
+    def _update_recipe_costs(cls, products):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Recipe.update_product_costs([p for p in products if p])
+
+    @classmethod
+    def create(cls, vlist):
+        cost_prices = super(ProductCostPrice, cls).create(vlist)
+        cls._update_recipe_costs([c.product for c in cost_prices])
+        return cost_prices
+
+    @classmethod
+    def write(cls, *args):
+        super(ProductCostPrice, cls).write(*args)
+        cls._update_recipe_costs([c.product for c in sum(args[::2], [])])
+
+    @classmethod
+    def delete(cls, cost_prices):
+        products = [c.product for c in cost_prices]
+        super(ProductCostPrice, cls).delete(cost_prices)
+        cls._update_recipe_costs(products)
@@ -0,0 +1,124 @@
+# This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.i18n import gettext
+from trytond.model import ModelView, ModelSQL, fields, Unique
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.modules.product import price_digits
+from sql import Window
+from sql.functions import RowNumber
+
+from . exceptions import SnapshotDateError
+
+SNAPSHOT_FIELDS = ['price', 'cost', 'cost_last', 'percentage',
+    'percentage_last']
+
+
+class RecipeCostSnapshot(ModelSQL, ModelView):
+    "Recipe Cost Snapshot"
+    __name__ = 'dish_recipe.recipe.cost.snapshot'
+    recipe = fields.Many2One('dish_recipe.recipe', 'Recipe',
+        required=True, ondelete='CASCADE', readonly=True)
+    company = fields.Many2One('company.company', 'Company',
+        required=True, ondelete='CASCADE', readonly=True)
+    date = fields.Date('Date', required=True, readonly=True)
+    price = fields.Numeric('Price', digits=price_digits, readonly=True)
+    cost = fields.Numeric('Cost', digits=price_digits, readonly=True)
+    cost_last = fields.Numeric('Last Cost', digits=price_digits,
+        readonly=True)
+    percentage = fields.Numeric('Percentage', digits=price_digits,
+        readonly=True)
+    percentage_last = fields.Numeric('Last Percentage', digits=price_digits,
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(RecipeCostSnapshot, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('recipe_company_date_uniq',
+                Unique(t, t.recipe, t.company, t.date),
+                'dish_recipe.msg_snapshot_recipe_company_date_unique'),
+            ]
+        cls._order = [
+            ('date', 'DESC'),
+            ('id', 'DESC'),
+            ]
+
+    @classmethod
+    def get_snapshots(cls, recipe_ids, date, company=None, strict=False):
+        """Return the values of the latest snapshot of recipes on or before
+        date (before when strict) for the company indexed by recipe id
+
+        The values include the date of the snapshot. Recipes without
+        snapshot are missing.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if company is None:
+            company = Transaction().context.get('company')
+        rank = RowNumber(window=Window([table.recipe],
+                order_by=[table.date.desc]))
+        columns = ['recipe', 'date'] + SNAPSHOT_FIELDS
+        result = {}
+        for sub_ids in grouped_slice(recipe_ids):
+            where = (reduce_ids(table.recipe, sub_ids)
+                & (table.company == company))
+            if strict:
+                where &= table.date < date
+            else:
+                where &= table.date <= date
+            query = table.select(
+                *[getattr(table, c) for c in columns], rank.as_('rank'),
+                where=where)
+            cursor.execute(*query.select(
+                    *[getattr(query, c) for c in columns],
+                    where=query.rank == 1))
+            for row in cursor:
+                values = dict(zip(columns, row))
+                result[values.pop('recipe')] = values
+        return result
+
+    @classmethod
+    def take_snapshots(cls, rows, date):
+        """Store the cost rows as returned by compute_catalog_costs at date
+
+        Only the rows which differ from the previous snapshot of the recipe
+        and company are stored, the others are still given by the previous
+        snapshot. So the date can not be earlier than the latest snapshot of
+        the companies.
+        """
+        by_company = {}
+        for row in rows:
+            by_company.setdefault(row[0], []).append(row)
+
+        latest = cls.search([
+                ('company', 'in', list(by_company)),
+                ], order=[('date', 'DESC')], limit=1)
+        if latest and date < latest[0].date:
+            raise SnapshotDateError(gettext(
+                    'dish_recipe.msg_snapshot_date_past',
+                    date=date, latest=latest[0].date))
+
+        to_delete, to_create = [], []
+        for company, company_rows in by_company.items():
+            recipe_ids = [r[1] for r in company_rows]
+            previous = cls.get_snapshots(
+                recipe_ids, date, company=company, strict=True)
+            for sub_ids in grouped_slice(recipe_ids):
+                to_delete += cls.search([
+                        ('company', '=', company),
+                        ('recipe', 'in', list(sub_ids)),
+                        ('date', '=', date),
+                        ])
+            for row in company_rows:
+                values = dict(zip(SNAPSHOT_FIELDS, row[2:]))
+                last = previous.get(row[1])
+                if last and all(last[f] == values[f]
+                        for f in SNAPSHOT_FIELDS):
+                    continue
+                values.update(recipe=row[1], company=company, date=date)
+                to_create.append(values)
+        cls.delete(to_delete)
+        cls.create(to_create)
@@ -0,0 +1,259 @@
+# This file is part of tryton-dish_recipe module. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Benchmark of the recipe costing and web rendering
+
+A synthetic catalog is built in the test database (SQLite in memory by
+default) and each scenario runs in a new transaction. For each scenario the
+number of queries, the wall time and the peak of Python memory are reported.
+
+Run with:
+
+    python -m trytond.modules.dish_recipe.tests.benchmark --recipes 500
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER
+from trytond.transaction import Transaction
+from trytond.modules.company.tests import create_company
+from trytond.modules.dish_recipe.tools import (_base64_cache,
+    tool_set_trace_callback)
+
+_results = []
+
+
+@contextmanager
+def measure(name):
+    "Measure the queries, the time and the memory of the block"
+    connection = Transaction().connection
+    queries = [0]
+
+    def trace(statement):
+        queries[0] += 1
+        if previous:
+            previous(statement)
+    counting = hasattr(connection, 'set_trace_callback')
+    if counting:
+        previous = tool_set_trace_callback(connection, trace)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if counting:
+            tool_set_trace_callback(connection, previous)
+        _results.append(
+            (name, queries[0] if counting else None, duration, peak))
+
+
+def build_catalog(options):
+    "Create the catalog and return the recipe and company ids"
+    pool = Pool()
+    Recipe = pool.get('dish_recipe.recipe')
+    Category = pool.get('dish_recipe.category')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    Uom = pool.get('product.uom')
+    CostPrice = pool.get('product.cost_price')
+    LastCost = pool.get('dish_recipe.product.last_cost')
+    Attachment = pool.get('ir.attachment')
+
+    kilogram, = Uom.search([('symbol', '=', 'kg')])
+    companies = []
+    for i in range(options.companies):
+        company = create_company(name='Company %s' % i,
+            currency=companies[0].currency if companies else None)
+        companies.append(company)
+
+    Category.create([{'name': 'Benchmark'}])
+    templates = Template.create([{
+                'name': 'Product %s' % i,
+                'default_uom': kilogram.id,
+                } for i in range(options.products)])
+    products = Product.create([{'template': t.id} for t in templates])
+    CostPrice.create([{
+                'product': p.id,
+                'company': c.id,
+                'cost_price': Decimal(i % 50 + 1) / 4,
+                } for c in companies for i, p in enumerate(products)])
+    LastCost.create([{
+                'product': p.id,
+                'company': c.id,
+                'unit_price': Decimal(i % 50 + 1) / 5,
+                'unit': kilogram.id,
+                } for c in companies
+            for i, p in enumerate(products[:options.last_costs])])
+
+    def values():
+        per_level = max(options.recipes // options.depth, 1)
+        for i in range(options.recipes):
+            level = min(i // per_level, options.depth - 1)
+            subrecipes = []
+            if level:
+                subrecipes.append({
+                        'subrecipe': 'Recipe %s' % (i - per_level),
+                        'quantity': 0.5,
+                        })
+            yield {
+                'name': 'Recipe %s' % i,
+                'description': 'Description of recipe %s\nServed hot' % i,
+                'category': 'Benchmark',
+                'components': [{
+                        'product': 'Product %s' % (
+                            (i + j) % options.products),
+                        'quantity': 10 * (j + 1),
+                        'unit': 'g',
+                        'waste': 5.0,
+                        'taxes': False,
+                        } for j in range(options.components)],
+                'subrecipes': subrecipes,
+                'prices': [{
+                        'company': c.rec_name,
+                        'price': '20.0',
+                        } for c in companies],
+                'publishes': [{
+                        'company': c.rec_name,
+                        'publish': bool(i % 2),
+                        } for c in companies],
+                }
+    recipes = Recipe.import_recipes(values())
+    if options.image_size:
+        data = os.urandom(options.image_size)
+        Attachment.create([{
+                    'name': 'image.jpg',
+                    'resource': str(r),
+                    'data': data,
+                    } for r in recipes])
+    if Recipe.stored_costs():
+        Recipe.recost_catalog()
+    return [r.id for r in recipes], [c.id for c in companies]
+
+
+def run(options):
+    activate_module('dish_recipe')
+    if options.stored_costs:
+        if not config.has_section('dish_recipe'):
+            config.add_section('dish_recipe')
+        config.set('dish_recipe', 'stored_costs', 'True')
+
+    with Transaction().start(DB_NAME, USER, context={}) as transaction:
+        with measure('build catalog'):
+            recipe_ids, company_ids = build_catalog(options)
+        transaction.commit()
+
+    context = {'company': company_ids[0], 'language': 'en'}
+    fields = ['name', 'price', 'cost', 'cost_last', 'percentage',
+        'percentage_last']
+
+    def scenario(name, func):
+        with Transaction().start(DB_NAME, USER, context=context):
+            with measure(name):
+                func()
+
+    def clear_caches():
+        "Empty the caches of the rendering shared between transactions"
+        with Transaction().start(DB_NAME, USER, context=context):
+            Recipe = Pool().get('dish_recipe.recipe')
+            Recipe._html_cache.clear()
+            _base64_cache.clear()
+
+    def list_read():
+        Recipe = Pool().get('dish_recipe.recipe')
+        Recipe.read(recipe_ids, fields)
+
+    def form_on_change():
+        Recipe = Pool().get('dish_recipe.recipe')
+        recipe = Recipe(recipe_ids[-1])
+        component = recipe.components[0]
+        component.quantity += 1
+        component.total_cost = component.on_change_with_total_cost()
+        recipe.components = recipe.components
+        recipe.on_change_components()
+
+    def bulk_recost():
+        Recipe = Pool().get('dish_recipe.recipe')
+        Recipe.compute_catalog_costs(recipe_ids, company_ids)
+
+    def render_menu():
+        Recipe = Pool().get('dish_recipe.recipe')
+        company = context['company']
+        for recipe in Recipe.browse(recipe_ids):
+            if not recipe.can_publish(company=company):
+                continue
+            recipe.get_html_field_text('name', 'en')
+            recipe.get_html_field_text('description', 'en')
+            recipe.get_html_price('price', company=company)
+            recipe.get_html_base64_image('image.jpg', size='thumb')
+
+    def render_menu_batch():
+        Recipe = Pool().get('dish_recipe.recipe')
+        company = context['company']
+        recipes = Recipe.browse(recipe_ids)
+        publish = Recipe.can_publish_recipes(recipes, company=company)
+        recipes = [r for r in recipes if publish[r.id]]
+        Recipe.get_html_fields_text(recipes, ['name', 'description'], 'en')
+        Recipe.get_html_prices(recipes, company=company)
+        for recipe in recipes:
+            recipe.get_html_base64_image('image.jpg', size='thumb')
+
+    scenario('list read', list_read)
+    scenario('form on_change', form_on_change)
+    scenario('bulk recost', bulk_recost)
+    clear_caches()
+    scenario('menu render (cold)', render_menu)
+    scenario('menu render (warm)', render_menu)
+    clear_caches()
+    scenario('menu batch (cold)', render_menu_batch)
+    scenario('menu batch (warm)', render_menu_batch)
+
+
+def report(options, file=sys.stdout):
+    print('recipes=%(recipes)s components=%(components)s depth=%(depth)s '
+        'companies=%(companies)s products=%(products)s '
+        'last_costs=%(last_costs)s stored_costs=%(stored_costs)s'
+        % vars(options), file=file)
+    print('%-20s %10s %10s %12s' % ('scenario', 'queries', 'time (s)',
+            'memory (MB)'), file=file)
+    for name, queries, duration, peak in _results:
+        print('%-20s %10s %10.3f %12.1f' % (name,
+                queries if queries is not None else 'n/a', duration,
+                peak / 1024 / 1024), file=file)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the recipe costing and web rendering")
+    parser.add_argument('--recipes', type=int, default=200)
+    parser.add_argument('--components', type=int, default=10,
+        help="number of components per recipe")
+    parser.add_argument('--depth', type=int, default=3,
+        help="number of levels of nested subrecipes")
+    parser.add_argument('--companies', type=int, default=1)
+    parser.add_argument('--products', type=int, default=100)
+    parser.add_argument('--last-costs', type=int, default=100,
+        dest='last_costs',
+        help="number of products with a last purchase cost per company")
+    parser.add_argument('--image-size', type=int, default=50 * 1024,
+        dest='image_size', help="size in bytes of the recipe images")
+    parser.add_argument('--stored-costs', action='store_true',
+        dest='stored_costs')
+    options = parser.parse_args(args)
+    options.depth = max(options.depth, 1)
+    options.companies = max(options.companies, 1)
+    options.products = max(options.products, 1)
+    run(options)
+    report(options)
+
+
+if __name__ == '__main__':
+    main()
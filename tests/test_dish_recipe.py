@@ -1,17 +1,39 @@
 # This file is part of tryton-dish_recipe module. The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
+from unittest.mock import patch
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.pool import Pool
 from trytond.transaction import Transaction
-from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.config import config
+from trytond.tests.test_tryton import (ModuleTestCase, with_transaction,
+    DB_NAME)
 from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
 from decimal import Decimal
+import datetime
+import base64
+import io
+try:
+    import PIL
+    from PIL import Image
+except ImportError:
+    PIL = None
+from trytond.modules.dish_recipe import tools
+from trytond.modules.dish_recipe.exceptions import (RecipeCycleError,
+    RecipeImportError, RecipeProductError, SnapshotDateError)
 
 
 class DishRecipeTestCase(ModuleTestCase):
     'Test Dish Recipe module'
     module = 'dish_recipe'
+    extras = ['account_invoice']
 
     @with_transaction()
     def test_dish_recipe(self):
@@ -101,6 +123,933 @@ class DishRecipeTestCase(ModuleTestCase):
             self._check_nums(recipe_2,
                 Decimal('1000.0'), Decimal('2500.0'), Decimal('40.0'))
 
+    @with_transaction()
+    def test_recipe_cost_batch(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+
+        company = create_company()
+        category = Category(name='Category')
+        category.save()
+        product = self._create_product('product', 'Kilogram')
+
+        with set_company(company):
+            self._update_product_cost(product.id, Decimal('10.0'))
+            recipes = []
+            for i in range(1, 6):
+                recipe = Recipe(name='Recipe %s' % i, category=category)
+                recipe.price = Decimal('100.0')
+                recipe.save()
+                self._add_component(recipe, product, 100 * i)
+                recipes.append(recipe)
+            base = recipes[0]
+            for recipe in recipes[1:]:
+                self._add_subrecipe(recipe, base, 1)
+
+            values = Recipe.read([r.id for r in recipes],
+                ['cost', 'cost_last', 'percentage', 'percentage_last'])
+            for value, i in zip(values, range(1, 6)):
+                cost = Decimal(i) + (Decimal('1.0') if i > 1 else 0)
+                self.assertEqual(value['cost'], cost)
+                self.assertEqual(value['cost_last'], Decimal('0.0'))
+                self.assertEqual(value['percentage'], cost)
+                self.assertEqual(value['percentage_last'], Decimal('0.0'))
+
+    @with_transaction()
+    def test_recipe_catalog_costs(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        User = pool.get('res.user')
+
+        company = create_company()
+        other = create_company(name='Other', currency=company.currency)
+        category = Category(name='Category')
+        category.save()
+        product = self._create_product('product', 'Kilogram')
+
+        with set_company(company):
+            self._update_product_cost(product.id, Decimal('10.0'))
+            recipes = []
+            for i in range(1, 4):
+                recipe = Recipe(name='Recipe %s' % i, category=category)
+                recipe.price = Decimal('100.0')
+                recipe.save()
+                self._add_component(recipe, product, 100 * i)
+                recipes.append(recipe)
+            self._add_subrecipe(recipes[2], recipes[0], 1)
+
+            values = Recipe.read([r.id for r in recipes],
+                ['cost', 'cost_last', 'percentage', 'percentage_last'])
+            rows = Recipe.compute_catalog_costs(
+                [r.id for r in recipes], [company.id], batch_size=2)
+            self.assertEqual(len(rows), len(recipes))
+            for row, value in zip(rows, values):
+                self.assertEqual(row[:3],
+                    (company.id, value['id'], Decimal('100.0')))
+                self.assertEqual(row[3:], (value['cost'], value['cost_last'],
+                        value['percentage'], value['percentage_last']))
+
+            user = User(login='cook', name='Cook', companies=[company],
+                company=company)
+            user.save()
+            with Transaction().set_user(user.id):
+                self.assertEqual(Recipe.get_catalog_costs(
+                        [r.id for r in recipes], [company.id, other.id],
+                        batch_size=2), rows)
+
+    @with_transaction()
+    def test_recipe_publish(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+
+        company = create_company()
+        category = Category(name='Category')
+        category.save()
+
+        with set_company(company):
+            recipes = Recipe.create([{
+                        'name': 'Recipe %s' % i,
+                        'category': category.id,
+                        'price': Decimal('100.0'),
+                        } for i in range(1, 4)])
+            recipes[0].publish = True
+            recipes[0].save()
+            recipes[1].active = False
+            recipes[1].save()
+            self.assertEqual(Recipe.can_publish_recipes(
+                    recipes, company=company.id),
+                {recipes[0].id: True, recipes[1].id: None,
+                    recipes[2].id: False})
+            self.assertEqual(
+                Recipe.get_html_prices(recipes[:2], company=company.id),
+                {recipes[0].id: '100.00', recipes[1].id: '100.00'})
+
+    @with_transaction()
+    def test_last_cost_invoices(self):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        LastCost = pool.get('dish_recipe.product.last_cost')
+        User = pool.get('res.user')
+        Group = pool.get('res.group')
+        ModelData = pool.get('ir.model.data')
+
+        company = create_company()
+        with set_company(company):
+            supplier, category = self._setup_accounting(company)
+            product_1 = self._create_product(
+                'product 1', 'Kilogram', account_category=category)
+            product_2 = self._create_product(
+                'product 2', 'Kilogram', account_category=category)
+            account_group = Group(ModelData.get_id('account', 'group_account'))
+            user = User(login='accountant', name='Accountant',
+                groups=[account_group], companies=[company], company=company)
+            user.save()
+
+            invoice_1 = self._create_supplier_invoice(
+                supplier, datetime.date(2020, 3, 1),
+                [(product_1, 1, Decimal('3.0')), (product_2, 2, Decimal('5.0'))])
+            invoice_2 = self._create_supplier_invoice(
+                supplier, datetime.date(2020, 4, 1),
+                [(product_1, 1, Decimal('4.0'))])
+            with Transaction().set_user(user.id), \
+                    Transaction().set_context(_check_access=True):
+                Invoice.post(Invoice.browse([invoice_1.id, invoice_2.id]))
+
+            def last_costs():
+                return {(c.product, c.unit_price, c.invoice_date)
+                    for c in LastCost.search([])}
+            expected = {
+                (product_1, Decimal('4.0'), datetime.date(2020, 4, 1)),
+                (product_2, Decimal('5.0'), datetime.date(2020, 3, 1)),
+                }
+            self.assertEqual(last_costs(), expected)
+
+            LastCost.delete(LastCost.search([]))
+            LastCost._fill_last_costs()
+            self.assertEqual(last_costs(), expected)
+
+            LastCost.delete(LastCost.search(
+                    [('product', '=', product_2.id)]))
+            LastCost.rebuild([company])
+            self.assertEqual(last_costs(), expected)
+
+            Invoice.cancel([invoice_2])
+            self.assertEqual(last_costs(), {
+                    (product_1, Decimal('3.0'), datetime.date(2020, 3, 1)),
+                    (product_2, Decimal('5.0'), datetime.date(2020, 3, 1)),
+                    })
+
+    @with_transaction()
+    def test_last_cost_query(self):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        LastCost = pool.get('dish_recipe.product.last_cost')
+        Component = pool.get('dish_recipe.recipe.component')
+
+        company = create_company()
+        with set_company(company):
+            supplier, category = self._setup_accounting(company)
+            products = [self._create_product('product %s' % i, 'Kilogram',
+                    account_category=category) for i in range(3)]
+            march, april = datetime.date(2020, 3, 1), datetime.date(2020, 4, 1)
+            invoices = [
+                self._create_supplier_invoice(supplier, march,
+                    [(products[0], 1, Decimal('1.0')),
+                        (products[1], 1, Decimal('2.0'))]),
+                # Same date, the last line wins
+                self._create_supplier_invoice(supplier, april,
+                    [(products[0], 1, Decimal('3.0')),
+                        (products[0], 1, Decimal('4.0'))]),
+                self._create_supplier_invoice(supplier, march,
+                    [(products[1], 1, Decimal('5.0'))]),
+                ]
+            Invoice.post(invoices)
+            # Draft invoices are ignored
+            self._create_supplier_invoice(supplier, april,
+                [(products[1], 1, Decimal('9.0')),
+                    (products[2], 1, Decimal('9.0'))])
+
+            kilogram = self._get_uom('Kilogram')
+            ids = [p.id for p in products]
+            self.assertEqual(LastCost.compute_last_costs(ids, company.id), {
+                    products[0].id: (Decimal('4.0'), kilogram.id, april),
+                    products[1].id: (Decimal('5.0'), kilogram.id, march),
+                    })
+            self.assertEqual(LastCost.compute_last_costs(
+                    ids, company.id, date=march), {
+                    products[0].id: (Decimal('1.0'), kilogram.id, march),
+                    products[1].id: (Decimal('5.0'), kilogram.id, march),
+                    })
+            self.assertEqual(Component._get_last_costs(products, date=march),
+                {
+                    products[0].id: (Decimal('1.0'), kilogram),
+                    products[1].id: (Decimal('5.0'), kilogram),
+                    })
+
+    @with_transaction()
+    def test_recipe_html_translations(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        Translation = pool.get('ir.translation')
+
+        category = Category(name='Category')
+        category.save()
+        recipes = Recipe.create([{
+                    'name': 'Recipe %s' % i,
+                    'category': category.id,
+                    } for i in range(1, 3)])
+        Translation.create([{
+                    'type': 'model',
+                    'name': 'dish_recipe.recipe,name',
+                    'res_id': recipes[0].id,
+                    'lang': 'fr',
+                    'src': recipes[0].name,
+                    'value': 'Recette\n1',
+                    }])
+        texts = Recipe.get_html_fields_text(recipes, ['name'], 'fr')
+        self.assertEqual(texts, {
+                recipes[0].id: {'name': 'Recette<br/>1'},
+                recipes[1].id: {'name': 'Recipe 2'},
+                })
+        self.assertEqual(
+            recipes[0].get_html_field_text('name', 'fr'), 'Recette<br/>1')
+
+    @with_transaction()
+    def test_recipe_html_cache(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        Translation = pool.get('ir.translation')
+        Lang = pool.get('ir.lang')
+
+        company = create_company()
+        category = Category(name='Category')
+        category.save()
+        french, = Lang.search([('code', '=', 'fr')])
+        french.translatable = True
+        french.save()
+
+        with set_company(company):
+            recipe = Recipe(name='Recipe', category=category)
+            recipe.price = Decimal('100.0')
+            recipe.save()
+            Translation.create([{
+                        'type': 'model',
+                        'name': 'dish_recipe.recipe,name',
+                        'res_id': recipe.id,
+                        'lang': 'fr',
+                        'src': recipe.name,
+                        'value': 'Recette',
+                        }])
+
+            self.assertEqual(recipe.get_html_field_text('name', None),
+                'Recipe')
+            self.assertEqual(recipe.get_html_field_text('name', 'fr'),
+                'Recette')
+            with Transaction().set_context(language='fr'):
+                self.assertEqual(Recipe(recipe.id).get_html_field_text(
+                        'name', None), 'Recette')
+            self.assertEqual(recipe.get_html_field_text('name', None),
+                'Recipe')
+            self.assertEqual(recipe.get_html_price(
+                    'price', company=company.id), '100.00')
+
+            recipe.name = 'Recipe One'
+            recipe.price = Decimal('120.0')
+            recipe.save()
+            self.assertEqual(recipe.get_html_field_text('name', None),
+                'Recipe One')
+            self.assertEqual(recipe.get_html_price(
+                    'price', company=company.id), '120.00')
+            Translation.write(Translation.search([
+                        ('name', '=', 'dish_recipe.recipe,name'),
+                        ('res_id', '=', recipe.id),
+                        ('lang', '=', 'fr'),
+                        ]), {'value': 'Recette Un'})
+            self.assertEqual(recipe.get_html_field_text('name', 'fr'),
+                'Recette Un')
+
+    @with_transaction()
+    def test_recipe_html_image(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        Attachment = pool.get('ir.attachment')
+
+        category = Category(name='Category')
+        category.save()
+        recipe = Recipe(name='Recipe', category=category)
+        recipe.save()
+        other = Recipe(name='Other', category=category)
+        other.save()
+
+        attachment, = Attachment.create([{
+                    'name': 'image.jpg',
+                    'resource': str(recipe),
+                    'data': b'image data',
+                    }])
+        image = 'image/jpeg;base64, ' + base64.b64encode(
+            b'image data').decode('utf-8')
+        self.assertEqual(recipe.get_html_base64_image('image.jpg'), image)
+        self.assertEqual(other.get_html_base64_image(
+                '[[%s]].image.jpg' % recipe.id), image)
+        self.assertEqual(other.get_html_base64_image('missing.jpg'), '')
+        self.assertEqual(''.join(recipe.iter_html_base64_image(
+                    'missing.jpg', default_image='image.jpg',
+                    chunk_size=4)), image)
+
+        # Only the resized images are cached
+        _, checksum = tools.tool_get_attachment(recipe, 'image.jpg')
+        self.assertIsNone(tools._base64_cache.get(
+                (attachment.id, checksum, 'image/jpeg', None)))
+        self.assertEqual(recipe.get_html_base64_image(
+                'image.jpg', size='thumb'), image)
+        self.assertEqual(tools._base64_cache.get(
+                (attachment.id, checksum, 'image/jpeg', 'thumb')), image)
+
+        # Large data is not cached
+        data = b'x' * tools.BASE64_CACHE_MAX_LENGTH
+        Attachment.write([attachment], {'data': data})
+        _, checksum = tools.tool_get_attachment(recipe, 'image.jpg')
+        self.assertEqual(recipe.get_html_base64_image(
+                'image.jpg', size='medium'), 'image/jpeg;base64, '
+            + base64.b64encode(data).decode('utf-8'))
+        self.assertIsNone(tools._base64_cache.get(
+                (attachment.id, checksum, 'image/jpeg', 'medium')))
+
+    @with_transaction()
+    def test_image_sizes(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        Attachment = pool.get('ir.attachment')
+
+        category = Category(name='Category')
+        category.save()
+        recipe = Recipe(name='Recipe', category=category)
+        recipe.save()
+        Attachment.create([{
+                    'name': 'image.jpg',
+                    'resource': str(recipe),
+                    'data': b'image data',
+                    }])
+        image = 'image/jpeg;base64, ' + base64.b64encode(
+            b'image data').decode('utf-8')
+
+        self.assertEqual(recipe.get_html_base64_image(
+                'image.jpg', size='full'), image)
+        # Data which is not an image is not resized
+        self.assertEqual(recipe.get_html_base64_image(
+                'image.jpg', size='thumb'), image)
+        with self.assertRaises(ValueError):
+            recipe.get_html_base64_image('image.jpg', size='huge')
+
+    @unittest.skipUnless(PIL, "Pillow is required")
+    @unittest.skipUnless(backend.name == 'sqlite', "SQLite only")
+    def test_image_variant(self):
+        "Test image variants on a file copy of the test database"
+        self._copy_database('variant')
+
+        with Transaction().start('variant', 0, context={}) as transaction:
+            pool = Pool()
+            Category = pool.get('dish_recipe.category')
+            Attachment = pool.get('ir.attachment')
+            ImageVariant = pool.get('dish_recipe.image.variant')
+
+            category = Category(name='Category')
+            category.save()
+            images = []
+            for size in [400, 100]:
+                data = io.BytesIO()
+                Image.new('RGB', (size, size)).save(data, format='JPEG')
+                images.append(data.getvalue())
+            # Variants are stored only for committed attachments
+            large, small = Attachment.create([{
+                        'name': 'image %s.jpg' % i,
+                        'resource': str(category),
+                        'data': data,
+                        } for i, data in enumerate(images)])
+            transaction.commit()
+
+            image = ImageVariant.get_image(large.id, 'checksum', 'thumb')
+            self.assertEqual(Image.open(io.BytesIO(image)).size, (200, 200))
+            variant, = ImageVariant.search([('attachment', '=', large.id)])
+            self.assertEqual(variant.image, image)
+            self.assertEqual(
+                ImageVariant.get_image(large.id, 'checksum', 'thumb'), image)
+
+            # An image within the size is not stored again
+            self.assertEqual(
+                ImageVariant.get_image(small.id, 'checksum', 'thumb'),
+                images[1])
+            self.assertFalse(
+                ImageVariant.search([('attachment', '=', small.id)]))
+
+    @with_transaction()
+    def test_component_taxes(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        Component = pool.get('dish_recipe.recipe.component')
+        LastCost = pool.get('dish_recipe.product.last_cost')
+        Tax = pool.get('account.tax')
+
+        company = create_company()
+        with set_company(company):
+            supplier, account_category = self._setup_accounting(company)
+            tax, = account_category.supplier_taxes
+            tax_10, = Tax.copy([tax], default={'rate': Decimal('0.1')})
+            account_category.supplier_taxes = [tax, tax_10]
+            account_category.save()
+            product = self._create_product(
+                'product', 'Kilogram', account_category=account_category)
+            self._update_product_cost(product.id, Decimal('10.0'))
+            LastCost.create([{
+                        'company': company.id,
+                        'product': product.id,
+                        'unit_price': Decimal('5.0'),
+                        'unit': product.default_uom.id,
+                        }])
+
+            category = Category(name='Category')
+            category.save()
+            recipe = Recipe(name='Recipe', category=category)
+            recipe.price = Decimal('100.0')
+            recipe.save()
+            components = []
+            for quantity in [1, 2]:
+                component = self._add_component(
+                    recipe, product, quantity, unit_name='Kilogram')
+                component.taxes = True
+                component.save()
+                components.append(component)
+
+            self.assertEqual(Component._compute_taxes_batch(
+                    [(product, Decimal('10.0')), (product, Decimal('10.0'))]),
+                [Decimal('3.0'), Decimal('3.0')])
+            costs = Component.get_costs(Component.browse(components))
+            for values, quantity in zip(costs, [1, 2]):
+                self.assertEqual(values['cost'], Decimal('13.0'))
+                self.assertEqual(values['cost_last'], Decimal('6.5'))
+                self.assertEqual(
+                    values['total_cost'], Decimal('13.0') * quantity)
+            recipe = Recipe(recipe.id)
+            self.assertEqual(recipe.cost, Decimal('39.0'))
+            self.assertEqual(recipe.cost_last, Decimal('19.5'))
+
+            # The taxes are those at the cost date
+            tax_10.start_date = datetime.date(2020, 1, 1)
+            tax_10.save()
+            with Transaction().set_context(
+                    _dish_recipe_cost_date=datetime.date(2019, 12, 31)):
+                self.assertEqual(Component._compute_taxes_batch(
+                        [(product, Decimal('10.0'))]), [Decimal('2.0')])
+            self.assertEqual(Component._compute_taxes_batch(
+                    [(product, Decimal('10.0'))]), [Decimal('3.0')])
+
+    @with_transaction()
+    def test_component_convert_costs(self):
+        pool = Pool()
+        Component = pool.get('dish_recipe.recipe.component')
+        Uom = pool.get('product.uom')
+
+        units = [self._get_uom(n) for n in ['Kilogram', 'Gram', 'Pound']]
+        values = [(Decimal('12.3456'), f, t) for f in units for t in units]
+        values.append((None, units[0], units[1]))
+        values.append((Decimal('1.0'), None, units[1]))
+        self.assertEqual(Component._convert_costs(values),
+            [Uom.compute_price(f, c, t) for c, f, t in values[:-2]]
+            + [Decimal('0.0'), Decimal('0.0')])
+
+    @with_transaction()
+    def test_instrument(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Component = pool.get('dish_recipe.recipe.component')
+
+        units = [self._get_uom(n) for n in ['Kilogram', 'Gram']]
+        values = [(Decimal('1.0'), f, t) for f in units for t in units]
+        values.append((None, units[0], units[1]))
+        Recipe.get_instrument_stats(reset=True)
+        Component._convert_costs(values)
+        self.assertEqual(Recipe.get_instrument_stats(), {})
+        with Transaction().set_context(dish_recipe_instrument=True):
+            Component._convert_costs(values)
+        stats = Recipe.get_instrument_stats(reset=True)
+        self.assertEqual(
+            stats['dish_recipe.recipe.component._convert_costs']['calls'], 1)
+        self.assertEqual(stats['product.uom.compute_price']['calls'], 1)
+        self.assertEqual(Recipe.get_instrument_stats(), {})
+
+        if backend.name == 'sqlite':
+            # The queries are still traced by the previous callback
+            connection = Transaction().connection
+            statements = []
+            previous = tools.tool_set_trace_callback(
+                connection, statements.append)
+            self.addCleanup(
+                tools.tool_set_trace_callback, connection, previous)
+            with Transaction().set_context(dish_recipe_instrument=True):
+                tools.tool_get_attachment(
+                    'dish_recipe.category,-1', 'image.jpg')
+            stats = Recipe.get_instrument_stats(reset=True)
+            self.assertTrue(statements)
+            self.assertEqual(
+                stats['tool_get_attachment']['queries'], len(statements))
+            self.assertEqual(tools.tool_set_trace_callback(
+                    connection, previous), statements.append)
+
+    @with_transaction()
+    def test_recipe_on_change(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        Component = pool.get('dish_recipe.recipe.component')
+
+        company = create_company()
+        category = Category(name='Category')
+        category.save()
+        product = self._create_product('product', 'Kilogram')
+
+        with set_company(company):
+            self._update_product_cost(product.id, Decimal('10.0'))
+            recipe = Recipe(name='Recipe', category=category)
+            recipe.price = Decimal('20.0')
+            recipe.save()
+            self._add_component(recipe, product, 100)
+
+            recipe = Recipe(recipe.id)
+            component, = recipe.components
+            component.quantity = 200
+            component.total_cost = component.on_change_with_total_cost()
+            new_component = Component(product=product,
+                unit=self._get_uom('Gram'), quantity=300, waste=None,
+                taxes=False)
+            recipe.components = [component, new_component]
+            recipe.on_change_components()
+            self.assertEqual(recipe.cost, Decimal('5.0'))
+            self.assertEqual(recipe.percentage, Decimal('25.0'))
+
+    @with_transaction()
+    def test_recipe_cycle(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+
+        category = Category(name='Category')
+        category.save()
+        recipe_1 = Recipe(name='Recipe 1', category=category)
+        recipe_1.save()
+        recipe_2 = Recipe(name='Recipe 2', category=category)
+        recipe_2.save()
+        recipe_3 = Recipe(name='Recipe 3', category=category)
+        recipe_3.save()
+        self._add_subrecipe(recipe_2, recipe_1, 1)
+        self._add_subrecipe(recipe_3, recipe_2, 1)
+        self._add_subrecipe(recipe_3, recipe_1, 1)
+
+        with self.assertRaises(RecipeCycleError):
+            self._add_subrecipe(recipe_1, recipe_3, 1)
+
+    @with_transaction()
+    def test_category_tree(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+
+        desserts, drinks = Category.create([
+                {'name': 'Desserts'}, {'name': 'Drinks'}])
+        cakes, = Category.create([{'name': 'Cakes', 'parent': desserts.id}])
+        chocolate, = Category.create([
+                {'name': 'Chocolate', 'parent': cakes.id}])
+        recipe = Recipe(name='Recipe', category=chocolate)
+        recipe.save()
+
+        self.assertEqual(chocolate.rec_name, 'Desserts / Cakes / Chocolate')
+        self.assertEqual(Recipe.search([
+                    ('category', 'child_of', [desserts.id], 'parent'),
+                    ]), [recipe])
+
+        company = create_company()
+        product = self._create_product('product', 'Kilogram')
+        with set_company(company):
+            self._update_product_cost(product.id, Decimal('10.0'))
+            for category, quantity in [(chocolate, 200), (cakes, 300)]:
+                other = Recipe(name='Other', category=category)
+                other.price = Decimal('10.0')
+                other.save()
+                self._add_component(other, product, quantity)
+
+            desserts, drinks = Category.browse([desserts.id, drinks.id])
+            self.assertEqual(desserts.recipe_count, 3)
+            self.assertEqual(desserts.cost_min, Decimal('0.0'))
+            self.assertEqual(desserts.cost_max, Decimal('3.0'))
+            self.assertEqual(desserts.percentage_average, Decimal('25.0'))
+            self.assertEqual(drinks.recipe_count, 0)
+            self.assertEqual(drinks.percentage_average, None)
+
+        cakes.parent = drinks
+        cakes.save()
+        self.assertEqual(
+            Category(chocolate.id).rec_name, 'Drinks / Cakes / Chocolate')
+        self.assertEqual(Recipe.search([
+                    ('category', 'child_of', [desserts.id], 'parent'),
+                    ]), [])
+        self.assertEqual(Category(drinks.id).recipe_count, 3)
+
+    @with_transaction()
+    def test_recipe_product_unique(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+
+        category = Category(name='Category')
+        category.save()
+        product = self._create_product('product', 'Kilogram')
+        recipe = Recipe(name='Recipe', category=category, product=product)
+        recipe.save()
+
+        recipe.active = False
+        recipe.save()
+        other, = Recipe.create([{
+                    'name': 'Other',
+                    'category': category.id,
+                    'product': product.id,
+                    }])
+
+        with self.assertRaises(RecipeProductError) as cm:
+            Recipe.create([{
+                        'name': 'Recipe %s' % i,
+                        'category': category.id,
+                        'product': product.id,
+                        } for i in range(2)])
+        self.assertEqual(len(cm.exception.message.splitlines()), 3)
+
+    @with_transaction()
+    def test_recipe_stored_costs(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+
+        if not config.has_section('dish_recipe'):
+            config.add_section('dish_recipe')
+        config.set('dish_recipe', 'stored_costs', 'True')
+        self.addCleanup(config.remove_option, 'dish_recipe', 'stored_costs')
+
+        company = create_company()
+        category = Category(name='Category')
+        category.save()
+        product = self._create_product('product', 'Kilogram')
+
+        with set_company(company):
+            recipe_1 = Recipe(name='Recipe 1', category=category)
+            recipe_1.price = Decimal('10.0')
+            recipe_1.save()
+            self._add_component(recipe_1, product, 500)
+            recipe_2 = Recipe(name='Recipe 2', category=category)
+            recipe_2.price = Decimal('10.0')
+            recipe_2.save()
+            self._add_subrecipe(recipe_2, recipe_1, 4)
+            recipe_3 = Recipe(name='Recipe 3', category=category)
+            recipe_3.save()
+            self.assertEqual(Recipe.get_product_recipes([product]),
+                [Recipe(recipe_1.id), Recipe(recipe_2.id)])
+
+            self._update_product_cost(product.id, Decimal('2.0'))
+            self.assertEqual(Recipe(recipe_1.id).cost, Decimal('1.0'))
+            self.assertEqual(Recipe(recipe_2.id).cost, Decimal('4.0'))
+            self.assertEqual(Recipe.search([
+                        ('percentage', '>', Decimal('35.0')),
+                        ]), [Recipe(recipe_2.id)])
+            self.assertEqual(Recipe.search([
+                        ('id', 'in', [recipe_1.id, recipe_2.id]),
+                        ], order=[('cost', 'DESC')]),
+                [Recipe(recipe_2.id), Recipe(recipe_1.id)])
+
+            recipe_2.price = Decimal('20.0')
+            recipe_2.save()
+            self.assertEqual(Recipe(recipe_2.id).percentage, Decimal('20.0'))
+
+            Recipe.recost_catalog()
+            self.assertEqual(Recipe.search([
+                        ('cost', '=', Decimal('4.0')),
+                        ]), [Recipe(recipe_2.id)])
+
+            config.set('dish_recipe', 'stored_costs', 'False')
+            tables = {None: (Recipe.__table__(), None)}
+            self.assertEqual(Recipe.order_cost(tables), [])
+            self.assertNotIn('stored_cost', tables)
+
+    @with_transaction()
+    def test_recipe_cost_snapshots(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        Snapshot = pool.get('dish_recipe.recipe.cost.snapshot')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        category = Category(name='Category')
+        category.save()
+        product = self._create_product('product', 'Kilogram')
+        today = Date.today()
+        dates = [today + datetime.timedelta(days=i) for i in range(3)]
+
+        with set_company(company):
+            recipe = Recipe(name='Recipe', category=category)
+            recipe.price = Decimal('10.0')
+            recipe.save()
+            self._add_component(recipe, product, 500)
+            self._update_product_cost(product.id, Decimal('2.0'))
+
+            Recipe.snapshot_costs()
+            Recipe.snapshot_costs(dates[1])
+            self.assertEqual(len(Snapshot.search([])), 1)
+            self._update_product_cost(product.id, Decimal('4.0'))
+            Recipe.snapshot_costs(dates[2])
+            self.assertEqual(len(Snapshot.search([])), 2)
+            # Back-dated snapshots would break the following ones
+            with self.assertRaises(SnapshotDateError):
+                Recipe.snapshot_costs(dates[1])
+            Recipe.snapshot_costs(dates[2])
+            self.assertEqual(len(Snapshot.search([])), 2)
+
+            costs = Recipe.get_costs_at([recipe], dates[1])[recipe.id]
+            self.assertEqual(costs['cost'], Decimal('1.0'))
+            self.assertEqual(costs['percentage'], Decimal('10.0'))
+            self.assertEqual(costs['date'], dates[0])
+            costs = Recipe.get_costs_at([recipe], dates[2])[recipe.id]
+            self.assertEqual(costs['cost'], Decimal('2.0'))
+            costs = Recipe.get_costs_at(
+                [recipe], today - datetime.timedelta(days=1))[recipe.id]
+            self.assertEqual(costs['cost'], Decimal('2.0'))
+            self.assertEqual(costs['cost_last'], Decimal('0.0'))
+            self.assertEqual(costs['date'], None)
+
+    @with_transaction()
+    def test_recipe_menu_costs(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+        Component = pool.get('dish_recipe.recipe.component')
+
+        company = create_company()
+        category = Category(name='Category')
+        category.save()
+        product_1 = self._create_product('product 1', 'Kilogram')
+        product_2 = self._create_product('product 2', 'Kilogram')
+
+        with set_company(company):
+            self._update_product_cost(product_1.id, Decimal('2.0'))
+            self._update_product_cost(product_2.id, Decimal('10.0'))
+            recipe_1 = Recipe(name='Recipe 1', category=category)
+            recipe_1.save()
+            self._add_component(recipe_1, product_1, 500)
+            recipe_2 = Recipe(name='Recipe 2', category=category)
+            recipe_2.save()
+            self._add_subrecipe(recipe_2, recipe_1, 4)
+            component = self._add_component(recipe_2, product_2, 100)
+            component.waste = 10.0
+            component.save()
+
+            menu = Recipe.get_menu_costs([
+                    (recipe_1, 2), (recipe_2, 3), (recipe_1, 1)])
+            self.assertEqual(menu['cost'],
+                3 * Recipe(recipe_1.id).cost + 3 * Recipe(recipe_2.id).cost)
+            self.assertEqual(menu['cost'], Decimal('18.3'))
+            gram = self._get_uom('Gram')
+            self.assertEqual(menu['products'], {
+                    (product_1.id, gram.id): 7500,
+                    (product_2.id, gram.id): 330,
+                    })
+
+            boms = Recipe.get_boms([recipe_1, recipe_2])
+            self.assertEqual(boms[recipe_1.id], {product_1.id: 0.5})
+            self.assertEqual(boms[recipe_2.id][product_1.id], 2.0)
+            self.assertAlmostEqual(boms[recipe_2.id][product_2.id], 0.11)
+            component.quantity = 200
+            component.save()
+            products = Recipe.explode_bom([(recipe_2, 10)])
+            self.assertEqual(products[product_1.id], 20.0)
+            self.assertAlmostEqual(products[product_2.id], 2.2)
+
+            # The expanded subrecipes are not loaded again
+            component.quantity = 100
+            component.save()
+            Recipe.get_boms([recipe_1])
+            with patch.object(Component, 'search',
+                    wraps=Component.search) as search:
+                boms = Recipe.get_boms([recipe_2])
+            self.assertEqual(search.call_count, 1)
+            self.assertAlmostEqual(boms[recipe_2.id][product_2.id], 0.11)
+
+    @unittest.skipUnless(backend.name == 'sqlite', "SQLite only")
+    def test_recipe_parallel_costs(self):
+        "Test parallel costing on a file copy of the test database"
+        self._copy_database('parallel')
+
+        with Transaction().start('parallel', 0, context={}) as transaction:
+            pool = Pool()
+            Recipe = pool.get('dish_recipe.recipe')
+            Category = pool.get('dish_recipe.category')
+
+            company = create_company()
+            category = Category(name='Category')
+            category.save()
+            products = [self._create_product('product %s' % i, 'Kilogram')
+                for i in range(3)]
+            with set_company(company):
+                for i, product in enumerate(products):
+                    self._update_product_cost(product.id, Decimal(i + 1))
+                recipes = []
+                for i in range(12):
+                    recipe = Recipe(name='Recipe %s' % i, category=category)
+                    recipe.price = Decimal('10.0')
+                    recipe.save()
+                    self._add_component(recipe, products[i % 3], 100 + i)
+                    if i >= 3 and i % 2:
+                        self._add_subrecipe(recipe, recipes[i - 3], 2)
+                    recipes.append(recipe)
+            transaction.commit()
+
+            ids = [r.id for r in recipes]
+            serial = Recipe.compute_catalog_costs(
+                ids, [company.id], processes=1)
+            parallel = Recipe.compute_catalog_costs(
+                ids, [company.id], processes=3)
+            self.assertEqual(parallel, serial)
+
+    @with_transaction()
+    def test_recipe_import_export(self):
+        pool = Pool()
+        Recipe = pool.get('dish_recipe.recipe')
+        Category = pool.get('dish_recipe.category')
+
+        if not config.has_section('dish_recipe'):
+            config.add_section('dish_recipe')
+        config.set('dish_recipe', 'stored_costs', 'True')
+        self.addCleanup(config.remove_option, 'dish_recipe', 'stored_costs')
+
+        company = create_company()
+        parent = Category(name='Parent')
+        parent.save()
+        category = Category(name='Category', parent=parent)
+        category.save()
+        product = self._create_product('product', 'Kilogram')
+
+        with set_company(company):
+            self._update_product_cost(product.id, Decimal('2.0'))
+            recipe_1 = Recipe(name='Recipe 1', category=category)
+            recipe_1.price = Decimal('10.0')
+            recipe_1.publish = True
+            recipe_1.save()
+            self._add_component(recipe_1, product, 500)
+            recipe_2 = Recipe(name='Recipe 2', category=category)
+            recipe_2.save()
+            self._add_subrecipe(recipe_2, recipe_1, 4)
+
+            data = io.StringIO()
+            Recipe.export_jsonl([recipe_2, recipe_1], data)
+            data.seek(0)
+            recipe_2_copy, recipe_1_copy = Recipe.import_jsonl(
+                data, batch_size=1)
+
+            self.assertEqual(recipe_1_copy.category, category)
+            self.assertEqual(recipe_1_copy.price, Decimal('10.0'))
+            self.assertEqual(recipe_1_copy.publish, True)
+            self.assertEqual(recipe_1_copy.cost, Decimal('1.0'))
+            self.assertEqual(
+                [s.subrecipe for s in recipe_2_copy.subrecipes],
+                [recipe_1_copy])
+            self.assertEqual(recipe_2_copy.cost, Decimal('4.0'))
+            self.assertEqual(Recipe.search([
+                        ('cost', '=', Decimal('4.0')),
+                        ], order=[('id', 'ASC')]), [recipe_2, recipe_2_copy])
+
+            # Subrecipes not exported are referenced by name
+            data = io.StringIO()
+            Recipe.export_jsonl([recipe_2], data)
+            data.seek(0)
+            with self.assertRaises(RecipeImportError):
+                Recipe.import_jsonl(data)
+            recipe_1_copy.name = 'Recipe 1 copy'
+            recipe_1_copy.save()
+            data.seek(0)
+            recipe_2_copy, = Recipe.import_jsonl(data)
+            self.assertEqual(
+                [s.subrecipe for s in recipe_2_copy.subrecipes], [recipe_1])
+
+            # Categories and products matching more than one record
+            data = io.StringIO()
+            Recipe.export_jsonl([recipe_1], data)
+            duplicate = Category(name='Category', parent=parent)
+            duplicate.save()
+            data.seek(0)
+            with self.assertRaises(RecipeImportError):
+                Recipe.import_jsonl(data)
+            Category.delete([duplicate])
+            self._create_product('product', 'Kilogram')
+            data.seek(0)
+            with self.assertRaises(RecipeImportError):
+                Recipe.import_jsonl(data)
+
+    def _copy_database(self, name):
+        "Copy the test database to a file database named name"
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with Transaction().start(DB_NAME, 0):
+            target = sqlite3.connect(os.path.join(path, name + '.sqlite'))
+            Transaction().connection.backup(target)
+            target.close()
+        database_path = config.get('database', 'path')
+        config.set('database', 'path', path)
+        self.addCleanup(config.set, 'database', 'path', database_path)
+        Pool(name).init()
+
     def _check_nums(self, recipe, cost, price, percentage):
         self.assertEqual(cost, recipe.cost)
         self.assertEqual(price, recipe.price)
@@ -136,7 +1085,63 @@ class DishRecipeTestCase(ModuleTestCase):
         return subrecipe
 
     @classmethod
-    def _create_product(cls, name, uom_name, service=False):
+    def _setup_accounting(cls, company):
+        """Create the chart of accounts and the fiscal year of 2020 of
+        company and return a supplier and a product category with a supplier
+        tax"""
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Account = pool.get('account.account')
+        Tax = pool.get('account.tax')
+        Category = pool.get('product.category')
+        Party = pool.get('party.party')
+
+        create_chart(company, tax=True)
+        fiscalyear = set_invoice_sequences(get_fiscalyear(
+                company, today=datetime.date(2020, 6, 1)))
+        fiscalyear.save()
+        FiscalYear.create_period([fiscalyear])
+        expense, = Account.search([
+                ('type.expense', '=', True),
+                ('company', '=', company.id),
+                ], limit=1)
+        tax, = Tax.search([('company', '=', company.id)])
+        category = Category(name='Supplies', accounting=True,
+            account_expense=expense, supplier_taxes=[tax])
+        category.save()
+        supplier = Party(name='Supplier', addresses=[{}])
+        supplier.save()
+        return supplier, category
+
+    @classmethod
+    def _create_supplier_invoice(cls, supplier, date, lines):
+        """Create a supplier invoice at date with lines, a list of
+        (product, quantity, unit price)"""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        Journal = pool.get('account.journal')
+        Company = pool.get('company.company')
+
+        journal, = Journal.search([('type', '=', 'expense')], limit=1)
+        company = Company(Transaction().context['company'])
+        invoice = Invoice(type='in', company=company,
+            currency=company.currency, party=supplier,
+            invoice_address=supplier.addresses[0], invoice_date=date,
+            journal=journal, account=supplier.account_payable_used)
+        invoice_lines = []
+        for product, quantity, unit_price in lines:
+            line = Line(type='line', product=product, quantity=quantity,
+                unit=product.default_uom, unit_price=unit_price)
+            line.account = product.account_expense_used
+            invoice_lines.append(line)
+        invoice.lines = invoice_lines
+        invoice.save()
+        return invoice
+
+    @classmethod
+    def _create_product(cls, name, uom_name, service=False,
+            account_category=None):
         pool = Pool()
         Template = pool.get('product.template')
         Product = pool.get('product.product')
@@ -150,6 +1155,8 @@ class DishRecipeTestCase(ModuleTestCase):
             name=name,
             default_uom=uom,
             type=type_,)
+        if account_category:
+            template.account_category = account_category
         template.save()
 
         product = Product(
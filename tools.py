@@ -1,40 +1,329 @@
-#This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
-#this repository contains the full copyright notices and license terms.
-from trytond.pool import Pool
-import base64
-
-
-def tool_get_html_field_text(model, field, id_res, text, lang):
-    pool = Pool()
-    Trans = pool.get('ir.translation')
-
-    if lang in (None, ''):
-        res = text.replace('\n', '<br/>')
-        return res
-
-    vals = Trans.search([
-        ('type', '=', 'model'),
-        ('name', '=', model + ',' + field),
-        ('res_id', '=', id_res),
-        ('lang', '=', lang)
-        ])
-    if vals:
-        res = vals[0].value
-    else:
-        res = text
-    res = res.replace('\n', '<br/>')
-    return res
-
-
-def tool_get_html_base64_image(recipe, image_name, code='image/jpeg'):
-    att_res = None
-    binary_data = None
-    res = None
-    for att in recipe.attachments:
-        if att.name == image_name:
-            binary_data = att.data
-            break
-    if binary_data is not None:
-        base64_encoded_data = base64.b64encode(binary_data)
-        res = code + ';base64, ' + base64_encoded_data.decode('utf-8')
-    return res
+#This file is part of tryton-dish_recipe project. The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.cache import Cache, LRUDictTransaction
+from trytond.config import config
+from trytond.tools import grouped_slice, reduce_ids
+from functools import wraps
+from . image import IMAGE_SIZES
+import base64
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+_instrument_stats = {}
+_instrument_lock = threading.Lock()
+_instrument_local = threading.local()
+
+
+def tool_instrument_enabled():
+    """Return if the calls of the instrumented functions are recorded
+
+    It is enabled by the context key ``dish_recipe_instrument`` or the
+    option ``instrument`` of the section ``dish_recipe`` of the configuration.
+    """
+    return bool(Transaction().context.get('dish_recipe_instrument')
+        or config.getboolean('dish_recipe', 'instrument', default=False))
+
+
+# The trace callbacks of the SQLite connections indexed by their id as SQLite
+# does not return the current callback
+_trace_callbacks = {}
+_sqlite_logger = logging.getLogger('trytond.backend.sqlite.database')
+
+
+def tool_set_trace_callback(connection, callback):
+    """Set the trace callback of the SQLite connection and return the
+    previous one
+
+    The previous callback is the one set by this function or else the debug
+    logger of the backend when it is enabled.
+    """
+    if _sqlite_logger.isEnabledFor(logging.DEBUG):
+        default = _sqlite_logger.debug
+    else:
+        default = None
+    previous = _trace_callbacks.get(id(connection), default)
+    connection.set_trace_callback(callback)
+    if callback is None:
+        _trace_callbacks.pop(id(connection), None)
+    else:
+        _trace_callbacks[id(connection)] = callback
+    return previous
+
+
+class _QueryCounter(object):
+    "Count the queries executed on a connection by nested calls"
+    __slots__ = ('count', 'depth', '_restore', '_previous')
+
+    def __init__(self, connection):
+        self.count, self.depth, self._restore = 0, 0, None
+        self._previous = None
+        if hasattr(connection, 'set_trace_callback'):
+            # SQLite
+            self._previous = tool_set_trace_callback(connection, self._trace)
+            self._restore = lambda: tool_set_trace_callback(
+                connection, self._previous)
+        elif getattr(connection, 'cursor_factory', None):
+            # PostgreSQL
+            factory = connection.cursor_factory
+            counter = self
+
+            class Cursor(factory):
+                def execute(self, *args, **kwargs):
+                    counter.count += 1
+                    return super(Cursor, self).execute(*args, **kwargs)
+
+                def executemany(self, *args, **kwargs):
+                    counter.count += 1
+                    return super(Cursor, self).executemany(*args, **kwargs)
+            connection.cursor_factory = Cursor
+            self._restore = lambda: setattr(
+                connection, 'cursor_factory', factory)
+        else:
+            self.count = None
+
+    def _trace(self, statement):
+        self.count += 1
+        if self._previous:
+            self._previous(statement)
+
+    @classmethod
+    def start(cls, connection):
+        counters = _instrument_local.__dict__.setdefault('counters', {})
+        counter = counters.get(id(connection))
+        if counter is None:
+            counter = counters[id(connection)] = cls(connection)
+        counter.depth += 1
+        return counter, counter.count
+
+    @classmethod
+    def stop(cls, connection, counter, start):
+        counter.depth -= 1
+        if not counter.depth:
+            del _instrument_local.counters[id(connection)]
+            if counter._restore:
+                counter._restore()
+        if counter.count is None:
+            return None
+        return counter.count - start
+
+
+def tool_instrument(name):
+    """Decorate a function to record the number of calls, the cumulative
+    time and the number of queries under name when instrumentation is
+    enabled
+
+    Each call is also logged as JSON at debug level.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tool_instrument_enabled():
+                return func(*args, **kwargs)
+            connection = Transaction().connection
+            counter, queries = _QueryCounter.start(connection)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                queries = _QueryCounter.stop(connection, counter, queries)
+                with _instrument_lock:
+                    stats = _instrument_stats.setdefault(name, {
+                            'calls': 0,
+                            'time': 0.0,
+                            'queries': 0,
+                            })
+                    stats['calls'] += 1
+                    stats['time'] += duration
+                    if queries is not None:
+                        stats['queries'] += queries
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(json.dumps({
+                                'name': name,
+                                'time': duration,
+                                'queries': queries,
+                                }))
+        return wrapper
+    return decorator
+
+
+def tool_get_instrument_stats(reset=False):
+    """Return the statistics of the instrumented functions of the process
+    indexed by name
+
+    Each value is a dictionary with the number of calls, the cumulative time
+    in seconds and the number of queries.
+    """
+    with _instrument_lock:
+        result = {n: dict(s) for n, s in _instrument_stats.items()}
+        if reset:
+            _instrument_stats.clear()
+    return result
+
+
+@tool_instrument('tool_get_html_field_text')
+def tool_get_html_field_text(model, field, id_res, text, lang):
+    pool = Pool()
+    Trans = pool.get('ir.translation')
+
+    if lang in (None, ''):
+        res = text.replace('\n', '<br/>')
+        return res
+
+    vals = Trans.search([
+        ('type', '=', 'model'),
+        ('name', '=', model + ',' + field),
+        ('res_id', '=', id_res),
+        ('lang', '=', lang)
+        ])
+    if vals:
+        res = vals[0].value
+    else:
+        res = text
+    res = res.replace('\n', '<br/>')
+    return res
+
+
+@tool_instrument('tool_get_html_fields_text')
+def tool_get_html_fields_text(model, fields, ids, lang):
+    """Return the html text of fields for the records ids of model indexed
+    by record id and field name
+
+    The translations for lang are read with a single query per slice of ids.
+    """
+    pool = Pool()
+    Model = pool.get(model)
+    Trans = pool.get('ir.translation')
+    trans = Trans.__table__()
+    cursor = Transaction().connection.cursor()
+
+    res = {}
+    for record in Model.browse(ids):
+        res[record.id] = {f: getattr(record, f) or '' for f in fields}
+
+    if lang not in (None, '') and ids and fields:
+        names = {model + ',' + f: f for f in fields}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*trans.select(
+                    trans.res_id, trans.name, trans.value,
+                    where=(trans.type == 'model')
+                    & trans.name.in_(list(names))
+                    & (trans.lang == lang)
+                    & reduce_ids(trans.res_id, sub_ids),
+                    order_by=trans.id.desc))
+            for res_id, name, value in cursor:
+                if res_id in res and value is not None:
+                    res[res_id][names[name]] = value
+
+    for values in res.values():
+        for field, text in values.items():
+            values[field] = text.replace('\n', '<br/>')
+    return res
+
+
+_base64_cache = Cache(
+    'dish_recipe.attachment.base64', size_limit=256, context=False)
+# Maximal length of the html base64 data kept in the cache, so the cache does
+# not hold more than size_limit times this length
+BASE64_CACHE_MAX_LENGTH = 128 * 1024
+
+
+@tool_instrument('tool_get_attachment')
+def tool_get_attachment(resource, name):
+    """Return the id and the checksum of the attachment named name of the
+    resource without reading its data
+
+    The checksum is the file id of the filestore or the last modification
+    date when the data is stored in the database.
+    """
+    pool = Pool()
+    Attachment = pool.get('ir.attachment')
+    attachments = Attachment.search_read([
+            ('resource', '=', str(resource)),
+            ('name', '=', name),
+            ], limit=1, order=[('id', 'ASC')],
+        fields_names=['id', 'file_id', 'create_date', 'write_date'])
+    if not attachments:
+        return None, None
+    attachment, = attachments
+    checksum = (attachment['file_id']
+        or attachment['write_date'] or attachment['create_date'])
+    return attachment['id'], checksum
+
+
+def _get_image_data(attachment_id, checksum, size=None):
+    pool = Pool()
+    Attachment = pool.get('ir.attachment')
+    ImageVariant = pool.get('dish_recipe.image.variant')
+    if size is None:
+        return Attachment(attachment_id).data
+    return ImageVariant.get_image(attachment_id, checksum, size)
+
+
+@tool_instrument('tool_get_base64_data')
+def tool_get_base64_data(attachment_id, checksum, code='image/jpeg',
+        size=None):
+    """Return the html base64 data of the attachment
+
+    size is one of the image sizes or None for the original data.
+    Only the resized images are cached and only up to
+    BASE64_CACHE_MAX_LENGTH.
+    """
+    cached = IMAGE_SIZES.get(size) is not None
+    key = (attachment_id, checksum, code, size)
+    res = _base64_cache.get(key) if cached else None
+    if res is None:
+        binary_data = _get_image_data(attachment_id, checksum, size)
+        if binary_data is None:
+            return None
+        base64_encoded_data = base64.b64encode(binary_data)
+        res = code + ';base64, ' + base64_encoded_data.decode('utf-8')
+        if cached and len(res) <= BASE64_CACHE_MAX_LENGTH:
+            _base64_cache.set(key, res)
+    return res
+
+
+def tool_iter_base64_data(attachment_id, checksum, code='image/jpeg',
+        chunk_size=3 * 64 * 1024, size=None):
+    """Return an iterator over the html base64 data of the attachment
+    encoding chunk_size bytes at a time"""
+    binary_data = _get_image_data(attachment_id, checksum, size)
+    # Only a multiple of 3 bytes is encoded without padding
+    chunk_size = max(chunk_size - chunk_size % 3, 3)
+
+    yield code + ';base64, '
+    if binary_data is not None:
+        data = memoryview(binary_data)
+        for i in range(0, len(data), chunk_size):
+            yield base64.b64encode(data[i:i + chunk_size]).decode('utf-8')
+
+
+def tool_get_html_base64_image(recipe, image_name, code='image/jpeg',
+        size=None):
+    attachment_id, checksum = tool_get_attachment(recipe, image_name)
+    if attachment_id is None:
+        return None
+    return tool_get_base64_data(attachment_id, checksum, code, size=size)
+
+
+def tool_get_transaction_cache(name, size_limit=10000):
+    """Return a cache dictionary shared for the whole transaction
+
+    The dictionary is emptied each time a record is created, written or
+    deleted in the transaction.
+    """
+    transaction = Transaction()
+    cache = transaction.cache.get(('dish_recipe', name))
+    if cache is None:
+        cache = transaction.cache[('dish_recipe', name)] = (
+            LRUDictTransaction(size_limit))
+    cache.refresh()
+    return cache
+